@@ -0,0 +1,358 @@
+import argparse
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import torch as t
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
+from loader import ngsimDataset
+from metrics import selectManeuver
+from synthetic import writeScenes
+from distributed import initProcessGroup, shardRange, allReduceSum
+from prefetch import Prefetcher, SerialWorker, toDevice
+from checkpoint import loadModel
+
+parser = argparse.ArgumentParser(description='Benchmarking:')
+parser.add_argument('--test_set', type=str, default='data/ngsim/TestSet.mat', help='Path to the .mat dataset')
+parser.add_argument('--repeats', type=int, default=20, help='timed repetitions per configuration')
+subparsers = parser.add_subparsers(dest='bench', required=True)
+
+collate_parser = subparsers.add_parser('collate', help='collate_fn against the per-sample reference loop')
+collate_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[128, 256, 512, 1024])
+
+pipeline_parser = subparsers.add_parser('pipeline', help='per-stage latency of the evaluation pipeline')
+pipeline_parser.add_argument('--model', type=str, default='trained_models/SSTT_ngsim.pth',
+                             help='model for the forward / metrics stages (skipped if the file is missing)')
+pipeline_parser.add_argument('--synthetic', type=float, default=None, metavar='DENSITY',
+                             help='benchmark a generated scene set with this many vehicles per lane per 100 ft '
+                                  'instead of --test_set')
+pipeline_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64, 256, 1024])
+pipeline_parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 2, 4])
+pipeline_parser.add_argument('--batches', type=int, default=20, help='batches timed per configuration')
+
+prefetch_parser = subparsers.add_parser('prefetch', help='sequential against pipelined evaluation loop')
+prefetch_parser.add_argument('--model', type=str, default='trained_models/SSTT_ngsim.pth')
+prefetch_parser.add_argument('--synthetic', type=float, default=None, metavar='DENSITY',
+                             help='benchmark a generated scene set instead of --test_set')
+prefetch_parser.add_argument('--batch_size', type=int, default=256)
+prefetch_parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 2, 4])
+prefetch_parser.add_argument('--batches', type=int, default=20, help='batches timed per configuration')
+prefetch_parser.add_argument('--depth', type=int, default=2, help='batches staged ahead / pending metrics')
+
+scaling_parser = subparsers.add_parser('scaling', help='throughput of sharded multi-process CPU evaluation')
+scaling_parser.add_argument('--model', type=str, default='trained_models/SSTT_ngsim.pth')
+scaling_parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+scaling_parser.add_argument('--threads', type=int, default=None, help='intra-op threads per process '
+                                                                     '(default: cores / processes)')
+scaling_parser.add_argument('--batch_size', type=int, default=256)
+scaling_parser.add_argument('--batches', type=int, default=20, help='batches per process')
+scaling_parser.add_argument('--port', type=int, default=29500)
+
+startup_parser = subparsers.add_parser('startup', help='cold start of the evaluation: imports, weight and data load')
+startup_parser.add_argument('--models', type=str, nargs='+', default=['trained_models/SSTT_ngsim.pth'],
+                            help='pickled models and / or checkpoints written by checkpoint.py')
+startup_parser.add_argument('--runs', type=int, default=5, help='fresh processes per configuration')
+startup_parser.add_argument('--batch_size', type=int, default=256)
+
+## Timed in a fresh interpreter: argv = repo dir, .mat file, model, batch size, lazy data load (0 / 1)
+STARTUP_CHILD = '''
+import json, sys, time
+te = time.perf_counter()
+import torch
+times = {'import torch': time.perf_counter() - te}
+sys.path.insert(0, sys.argv[1])
+te = time.perf_counter()
+from loader import ngsimDataset
+from checkpoint import loadModel
+times['import modules'] = time.perf_counter() - te
+lazy = sys.argv[5] == '1'
+te = time.perf_counter()
+dataset = ngsimDataset(sys.argv[2], lazy=lazy)
+times['data load'] = time.perf_counter() - te
+te = time.perf_counter()
+net = loadModel(sys.argv[3])
+times['weight load'] = time.perf_counter() - te
+te = time.perf_counter()
+dataset.tracks
+times['data load'] += time.perf_counter() - te
+te = time.perf_counter()
+data = dataset.collate_fn([dataset[i] for i in range(min(int(sys.argv[4]), len(dataset)))])
+hist, nbrs, mask, lat_enc, lon_enc, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = data
+with torch.no_grad():
+    net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+times['first batch'] = time.perf_counter() - te
+print(json.dumps(times))
+'''
+
+
+def timeit(fn, repeats):
+    fn()  # warm up
+    times = []
+    for _ in range(repeats):
+        te = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - te)
+    return np.array(times)
+
+
+def benchCollate(dataset, batch_sizes, repeats):
+    n = min(len(dataset), max(batch_sizes))
+    samples = [dataset[i] for i in range(n)]
+    print('{:>10} {:>12} {:>12} {:>8}'.format('batch', 'loop (ms)', 'batched (ms)', 'speedup'))
+    for batch_size in batch_sizes:
+        batch = [samples[i % n] for i in range(batch_size)]
+        for ref, out in zip(dataset.collate_fn_loop(batch), dataset.collate_fn(batch)):
+            assert ref.dtype == out.dtype and t.equal(ref, out), 'collate_fn output differs from the reference'
+        loop = np.median(timeit(lambda: dataset.collate_fn_loop(batch), repeats)) * 1000
+        batched = np.median(timeit(lambda: dataset.collate_fn(batch), repeats)) * 1000
+        print('{:>10} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(batch_size, loop, batched, loop / batched))
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        t.cuda.synchronize()
+
+
+def percentiles(times):
+    return np.percentile(np.asarray(times) * 1000, [50, 95, 99])
+
+
+## Stage-by-stage timing in the main process: __getitem__ (summed over the batch), collate_fn, host to
+## device copy, Net.forward and the metric computation, each followed by a device synchronization
+def timeStages(dataset, net, device, batch_size, batches):
+    stages = dict((name, []) for name in ('__getitem__', 'collate_fn', 'to device', 'forward', 'metrics'))
+    order = np.random.default_rng(0).permutation(len(dataset))
+    for b in range(batches):
+        index = order[np.arange(b * batch_size, (b + 1) * batch_size) % len(dataset)]
+        te = time.perf_counter()
+        samples = [dataset[i] for i in index]
+        stages['__getitem__'].append(time.perf_counter() - te)
+        te = time.perf_counter()
+        data = dataset.collate_fn(samples)
+        stages['collate_fn'].append(time.perf_counter() - te)
+        te = time.perf_counter()
+        data = [d.to(device) for d in data]
+        synchronize(device)
+        stages['to device'].append(time.perf_counter() - te)
+        if net is None:
+            continue
+        hist, nbrs, mask, lat_enc, lon_enc, fut, op_mask, va, nbrsva, _, _, _, _, cls, nbrscls, _ = data
+        with t.no_grad():
+            te = time.perf_counter()
+            fut_pred, _, _ = net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+            synchronize(device)
+            stages['forward'].append(time.perf_counter() - te)
+            te = time.perf_counter()
+            fut_pred = selectManeuver(fut_pred, lat_enc, lon_enc)
+            mask = op_mask[:net.out_length, :, 0]
+            fut = fut[:net.out_length]
+            sq_err = ((fut_pred[:, :, 0] - fut[:, :, 0]) ** 2 + (fut_pred[:, :, 1] - fut[:, :, 1]) ** 2) * mask
+            sq_err.sum(1).cpu()
+            stages['metrics'].append(time.perf_counter() - te)
+    return stages
+
+
+## Batch latency as seen by the consumer of a DataLoader (waiting for the next batch, copy and forward)
+## and the resulting end-to-end throughput
+def timeLoader(dataset, net, device, batch_size, num_workers, batches):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                        collate_fn=dataset.collate_fn)
+    times = []
+    samples = 0
+    start = te = time.perf_counter()
+    for b, data in enumerate(loader):
+        if b == batches:
+            break
+        data = [d.to(device) for d in data]
+        if net is not None:
+            hist, nbrs, mask, lat_enc, lon_enc, fut, op_mask, va, nbrsva, _, _, _, _, cls, nbrscls, _ = data
+            with t.no_grad():
+                net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+        synchronize(device)
+        samples += data[0].shape[1]
+        now = time.perf_counter()
+        times.append(now - te)
+        te = now
+    return np.array(times), samples / (time.perf_counter() - start)
+
+
+## Samples/s of the evaluation loop over the first batches of a DataLoader: copy to the device, forward pass and
+## metric reduction (squared error per horizon, read back to the host) one after the other, or pipelined with
+## the next batches staged by a Prefetcher and the metrics reduced on a SerialWorker during the next forward pass
+def timeEvaluation(loader, net, device, batches, pipelined, depth):
+    sq_err = t.zeros(net.out_length, dtype=t.float64)
+
+    def reduce(fut_pred, lat_enc, lon_enc, fut, op_mask):
+        fut_pred = selectManeuver(fut_pred, lat_enc, lon_enc)
+        fut = fut[:net.out_length]
+        err = ((fut_pred[:, :, 0] - fut[:, :, 0]) ** 2 + (fut_pred[:, :, 1] - fut[:, :, 1]) ** 2)
+        sq_err.add_((err * op_mask[:net.out_length, :, 0]).sum(1).cpu())
+
+    stage = functools.partial(toDevice, device=device, non_blocking=pipelined)
+    worker = SerialWorker(depth) if pipelined else None
+    data_iter = Prefetcher(loader, stage, device, depth) if pipelined else loader
+    samples = 0
+    te = time.perf_counter()
+    with t.no_grad():
+        for b, data in enumerate(data_iter):
+            if b == batches:
+                break
+            if not pipelined:
+                data = stage(data)
+            hist, nbrs, mask, lat_enc, lon_enc, fut, op_mask, va, nbrsva, _, _, _, _, cls, nbrscls, _ = data
+            fut_pred, _, _ = net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+            if pipelined:
+                worker.submit(reduce, fut_pred, lat_enc, lon_enc, fut, op_mask)
+            else:
+                reduce(fut_pred, lat_enc, lon_enc, fut, op_mask)
+            samples += hist.shape[1]
+    if pipelined:
+        worker.close()
+    synchronize(device)
+    return samples / (time.perf_counter() - te), sq_err
+
+
+def benchPrefetch(mat_file, model, batch_size, num_workers, batches, depth):
+    device = t.device('cuda:0' if t.cuda.is_available() else 'cpu')
+    dataset = ngsimDataset(mat_file)
+    net = loadModel(model, device)
+    print('{:>8} {:>18} {:>18} {:>8}'.format('workers', 'sequential (1/s)', 'pipelined (1/s)', 'speedup'))
+    for workers in num_workers:
+        throughput = []
+        for pipelined in (False, True):
+            options = {}
+            if pipelined:
+                options['pin_memory'] = device.type == 'cuda'
+                if workers > 0:
+                    options['prefetch_factor'] = 4
+            loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers,
+                                collate_fn=dataset.collate_fn, **options)
+            timeEvaluation(loader, net, device, 1, pipelined, depth)  # warm up
+            throughput.append(timeEvaluation(loader, net, device, batches, pipelined, depth))
+        assert t.allclose(throughput[0][1], throughput[1][1]), 'pipelined metrics differ from the sequential loop'
+        print('{:>8} {:>18.0f} {:>18.0f} {:>7.2f}x'.format(workers, throughput[0][0], throughput[1][0],
+                                                         throughput[1][0] / throughput[0][0]))
+
+
+def benchPipeline(mat_file, model, batch_sizes, num_workers, batches):
+    device = t.device('cuda:0' if t.cuda.is_available() else 'cpu')
+    te = time.perf_counter()
+    dataset = ngsimDataset(mat_file)
+    print('.mat load: {:.1f} ms, {} samples'.format((time.perf_counter() - te) * 1000, len(dataset)))
+    net = None
+    if os.path.exists(model):
+        net = loadModel(model, device)
+    else:
+        print('{} not found, skipping the forward and metrics stages'.format(model))
+
+    print('{:>6} {:<12} {:>9} {:>9} {:>9} {:>12}'.format('batch', 'stage', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)',
+                                                          'samples/s'))
+    for batch_size in batch_sizes:
+        for name, times in timeStages(dataset, net, device, batch_size, batches).items():
+            if times:
+                p = percentiles(times)
+                print('{:>6} {:<12} {:>9.2f} {:>9.2f} {:>9.2f} {:>12.0f}'.format(batch_size, name, p[0], p[1], p[2],
+                                                                               batch_size / np.median(times)))
+    print()
+    print('{:>6} {:>8} {:>9} {:>9} {:>9} {:>12}'.format('batch', 'workers', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)',
+                                                         'samples/s'))
+    for batch_size in batch_sizes:
+        for workers in num_workers:
+            times, throughput = timeLoader(dataset, net, device, batch_size, workers, batches)
+            p = percentiles(times)
+            print('{:>6} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>12.0f}'.format(batch_size, workers, p[0], p[1], p[2],
+                                                                           throughput))
+
+
+## One process of benchScaling: forward passes over its shard of the first world_size * batches batches.
+## Every process waits for the others before stopping its clock, so the averaged time is the wall time of the run.
+def scalingWorker(rank, world_size, mat_file, model, threads, batch_size, batches, port, result):
+    initProcessGroup(rank, world_size, port, threads)
+    dataset = ngsimDataset(mat_file)
+    start, end = shardRange(min(len(dataset), world_size * batches * batch_size), rank, world_size)
+    loader = DataLoader(Subset(dataset, range(start, end)), batch_size=batch_size, shuffle=False,
+                        collate_fn=dataset.collate_fn)
+    net = loadModel(model)
+    totals = t.zeros(2, dtype=t.float64)
+    te = time.perf_counter()
+    with t.no_grad():
+        for data in loader:
+            hist, nbrs, mask, lat_enc, lon_enc, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = data
+            net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+            totals[0] += hist.shape[1]
+    t.distributed.barrier()
+    totals[1] = time.perf_counter() - te
+    allReduceSum(totals)
+    if rank == 0:
+        result.put((totals[0].item(), totals[1].item() / world_size))
+    t.distributed.destroy_process_group()
+
+
+## Samples/s of 1..N evaluation processes with the same work per process (weak scaling), with the speedup and
+## parallel efficiency over one process
+def benchScaling(mat_file, model, processes, threads, batch_size, batches, port):
+    result = mp.get_context('spawn').SimpleQueue()
+    print('{} cores'.format(os.cpu_count()))
+    print('{:>10} {:>8} {:>10} {:>12} {:>8} {:>11}'.format('processes', 'threads', 'samples', 'samples/s',
+                                                           'speedup', 'efficiency'))
+    base = None
+    for world_size in processes:
+        mp.spawn(scalingWorker, args=(world_size, mat_file, model, threads, batch_size, batches, port + world_size,
+                                      result), nprocs=world_size)
+        samples, elapsed = result.get()
+        throughput = samples / elapsed
+        if base is None:
+            base = throughput / world_size  # per-process throughput of the first configuration
+        speedup = throughput / base
+        print('{:>10} {:>8} {:>10.0f} {:>12.0f} {:>7.2f}x {:>10.0%}'.format(
+            world_size, threads or max(1, (os.cpu_count() or 1) // world_size), samples, throughput, speedup,
+            speedup / world_size))
+
+
+## Median time of each cold start stage over fresh processes, for every model and with the eager and the
+## background (lazy) data load; with lazy loading, 'data load' is the time still spent waiting for the tracks
+## after the weights are loaded
+def benchStartup(mat_file, models, runs, batch_size):
+    repo = os.path.dirname(os.path.abspath(__file__))
+    stages = ('import torch', 'import modules', 'weight load', 'data load', 'first batch')
+    print('{:<40} {:>6}'.format('model', 'data') + ''.join('{:>16}'.format(name) for name in stages) +
+          '{:>10}'.format('total'))
+    for model in models:
+        for lazy in ('0', '1'):
+            results = []
+            for _ in range(runs):
+                out = subprocess.run([sys.executable, '-c', STARTUP_CHILD, repo, mat_file, model, str(batch_size), lazy],
+                                     check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+                results.append(json.loads(out.strip().splitlines()[-1]))
+            medians = [np.median([r[name] for r in results]) * 1000 for name in stages]
+            print('{:<40} {:>6}'.format(model[-40:], 'lazy' if lazy == '1' else 'eager') +
+                  ''.join('{:>13.0f} ms'.format(m) for m in medians) +
+                  '{:>7.0f} ms'.format(np.median([sum(r.values()) for r in results]) * 1000))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.bench == 'collate':
+        benchCollate(ngsimDataset(args.test_set), args.batch_sizes, args.repeats)
+    elif args.bench == 'pipeline':
+        mat_file = args.test_set
+        if args.synthetic is not None:
+            mat_file = os.path.join(tempfile.mkdtemp(), 'synthetic.mat')
+            writeScenes(mat_file, density=args.synthetic)
+        benchPipeline(mat_file, args.model, args.batch_sizes, args.num_workers, args.batches)
+    elif args.bench == 'prefetch':
+        mat_file = args.test_set
+        if args.synthetic is not None:
+            mat_file = os.path.join(tempfile.mkdtemp(), 'synthetic.mat')
+            writeScenes(mat_file, density=args.synthetic)
+        benchPrefetch(mat_file, args.model, args.batch_size, args.num_workers, args.batches, args.depth)
+    elif args.bench == 'startup':
+        benchStartup(args.test_set, args.models, args.runs, args.batch_size)
+    elif args.bench == 'scaling':
+        benchScaling(args.test_set, args.model, args.processes, args.threads, args.batch_size, args.batches,
+                     args.port)
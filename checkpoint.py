@@ -0,0 +1,64 @@
+from __future__ import print_function, division
+import argparse
+import pickle
+import torch as t
+
+parser = argparse.ArgumentParser(description='Converting to a state_dict checkpoint:')
+parser.add_argument('--model', type=str, default='trained_models/SSTT_ngsim.pth', help='pickled model')
+parser.add_argument('--out', type=str, default='trained_models/SSTT_ngsim.ckpt', help='checkpoint path')
+
+## Net constructor arguments and the (sub)module attribute each is stored in
+NET_ARGS = (('use_cuda', 'use_cuda'), ('train_flag', 'train_flag'), ('use_maneuvers', 'use_maneuvers'),
+            ('use_true_man', 'use_true_man'), ('in_length', 'in_length'), ('out_length', 'out_length'),
+            ('num_lat_classes', 'num_lat_classes'), ('num_lon_classes', 'num_lon_classes'),
+            ('num_features', 'num_features'), ('num_opt', 'num_opt'), ('ff_hidden_size', 'ff_hide_size'),
+            ('lstm_encoder_size', 'encoder_size'), ('decoder_size', 'decoder_size'), ('num_blocks', 'blocks'),
+            ('num_heads', 'n_head'), ('input_embed_size', 'input_embed_size'), ('soc_conv_depth', 'soc_conv_depth'),
+            ('conv_3x1_depth', 'conv_3x1_depth'), ('att_out_size', 'sparse_spatial.0.att_out_size'))
+
+
+def netArgs(net):
+    args = {}
+    for arg, path in NET_ARGS:
+        module, _, attr = path.rpartition('.')
+        args[arg] = getattr(net.get_submodule(module), attr)
+    return args
+
+
+## {'args', 'state_dict'} checkpoint: plain tensors and Python values, loadable with weights_only and mmap
+def saveCheckpoint(net, path):
+    t.save({'args': netArgs(net), 'state_dict': net.state_dict()}, path)
+
+
+## Net from a checkpoint written by saveCheckpoint. The module takes over the memory-mapped tensors instead of
+## copying them, so the weights are read from the page cache (shared by all processes) as they are used.
+def loadCheckpoint(path, device='cpu'):
+    from model import Net
+    checkpoint = t.load(path, mmap=True, weights_only=True, map_location='cpu')
+    net = Net(argparse.Namespace(**checkpoint['args']))
+    net.load_state_dict(checkpoint['state_dict'], assign=True)
+    return net.to(device).eval()
+
+
+## True for a model with (dynamic) quantized modules, such as the INT8 model written by quantize.py
+def isQuantized(net):
+    return any(type(module).__module__.startswith('torch.ao.nn.quantized') for module in net.modules())
+
+
+## Net from either a checkpoint or a fully pickled model (trained_models/SSTT_ngsim.pth). Quantized models
+## only have CPU kernels, so they are rejected for any other device.
+def loadModel(path, device='cpu'):
+    try:
+        return loadCheckpoint(path, device)
+    except pickle.UnpicklingError:  # pickled module, rejected by weights_only
+        net = t.load(path, map_location='cpu', weights_only=False).eval()
+    if isQuantized(net) and t.device(device).type != 'cpu':
+        raise ValueError('{} is a quantized model, which runs on CPU only (hide the GPUs with '
+                         'CUDA_VISIBLE_DEVICES= to evaluate it)'.format(path))
+    return net.to(device)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    saveCheckpoint(t.load(args.model, map_location='cpu', weights_only=False), args.out)
+    print('saved', args.out)
@@ -0,0 +1,26 @@
+from __future__ import print_function, division
+import os
+import torch
+import torch.distributed as dist
+
+
+## Joins the gloo process group of a single-node CPU run and sets the intra-op threads of this process
+## (default: the cores divided evenly between the processes)
+def initProcessGroup(rank, world_size, port=29500, threads=None):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(port))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(threads or max(1, (os.cpu_count() or 1) // world_size))
+
+
+## Contiguous [start, end) range of the n samples evaluated by rank
+def shardRange(n, rank, world_size):
+    return n * rank // world_size, n * (rank + 1) // world_size
+
+
+## In-place sum of the tensors over all processes (no-op without a process group)
+def allReduceSum(*tensors):
+    if dist.is_available() and dist.is_initialized():
+        for tensor in tensors:
+            dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensors
@@ -1,11 +1,21 @@
 import time
+import functools
 import torch as t
-from torch.utils.data import DataLoader
-from loader import ngsimDataset
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
+from loader import ngsimDataset, unpackNeighbors, expandScene, SceneBatchSampler, SceneBatches, NeighborBucketSampler
+from sample_cache import ngsimCacheDataset
+from track_store import TrackStore
+from inference import INFERENCE_BACKENDS, forwardManeuver, neighborCells, prepareNet, maskCells, loadExported
+from metrics import StratifiedMetrics, SUMS, bivariateNLL, multiModalNLL, selectManeuver
+from distributed import initProcessGroup, shardRange, allReduceSum
+from checkpoint import loadModel
+from profiling import ModuleProfiler
+from prediction_store import PredictionWriter
+from prefetch import Prefetcher, SerialWorker, toDevice
 import os
 import numpy as np
 from tqdm import tqdm
-import matplotlib
 import argparse
 
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
@@ -41,90 +51,249 @@ parser.add_argument('--num_heads', type=int, default=8, help='number of attentio
 parser.add_argument('--train_flag', type=bool, default=False, help='train flag')
 parser.add_argument('--use_maneuvers', type=bool, default=True, help='')
 parser.add_argument('--name', type=str, help='log name', default="ngsim")
+parser.add_argument('--model', type=str, default='trained_models/SSTT_ngsim.pth',
+                    help='model to evaluate: a pickled model, e.g. the INT8 model written by quantize.py (CPU only), '
+                         'or a state_dict checkpoint written by checkpoint.py (memory-mapped)')
+parser.add_argument('--exported_model', type=str, default=None,
+                    help='run a program saved by export.py instead of --model, without the Python model code')
 parser.add_argument('--test_set', type=str, default='data/ngsim/TestSet.mat', help='Path to validation datasets')
-parser.add_argument("--num_workers", type=int, default=8, help="number of workers used for dataloader")
+parser.add_argument("--num_workers", type=int, default=None,
+                    help="number of workers used for dataloader (default: 8, split among the --world_size processes)")
 parser.add_argument('--dataset_name', type=str, help='epochs of training using NLL', default='ngsim')
 parser.add_argument('--val_use_mse', type=bool, default=True, help='')
+parser.add_argument('--sample_cache', action='store_true', default=False,
+                    help='read samples from a memory-mapped cache built once from the .mat file')
+parser.add_argument('--cache_dir', type=str, default=None, help='sample cache location (default: next to test_set)')
+parser.add_argument('--track_store', type=str, default=None,
+                    help='directory of a memory-mapped track store shared by the dataloader workers (built on first use)')
+parser.add_argument('--stratified_metrics', action='store_true', default=False,
+                    help='also report RMSE/ADE/FDE/NLL by traffic level, maneuver and horizon')
+parser.add_argument('--metrics_out', type=str, default=None,
+                    help='save the stratified metric sums to this file (merge shards with metrics.py)')
+parser.add_argument('--decode_maneuver', type=str, default='all', choices=['all', 'true', 'pred'],
+                    help='MSE evaluation: decode all 9 maneuvers, or only the ground-truth / most likely one')
+parser.add_argument('--inference_backend', type=str, default='eager', choices=INFERENCE_BACKENDS,
+                    help='run the transformer blocks and decoder with torch.compile or bf16 autocast; '
+                         'the accuracy change against fp32 eager is reported')
+parser.add_argument('--sparse_spatial', action='store_true', default=False,
+                    help='compute the spatial attention over the occupied grid cells only')
+parser.add_argument('--compile_cache', type=str, default=None,
+                    help='directory of the compiled graph cache reused across runs (default: inductor temp dir)')
+parser.add_argument('--packed_batch', action='store_true', default=False,
+                    help='load neighbours in the packed batch layout (collate_fn_packed)')
+parser.add_argument('--profile', action='store_true', default=False,
+                    help='time the attention / transformer modules and the decoder, count their MACs (thop) and '
+                         'write a torch.profiler Chrome trace')
+parser.add_argument('--profile_dir', type=str, default='profile', help='output directory of --profile')
+parser.add_argument('--profile_batches', type=int, default=10, help='batches profiled with --profile')
+parser.add_argument('--predictions_out', type=str, default=None,
+                    help='write the per-sample predictions to this directory in chunks; an interrupted run with the '
+                         'same arguments resumes from the last chunk')
+parser.add_argument('--predictions_chunk', type=int, default=16384, help='samples per prediction chunk')
+parser.add_argument('--pipeline', action='store_true', default=False,
+                    help='stage the next batches on the device in a background thread and reduce the metrics of a '
+                         'batch during the next forward pass; the DataLoader pins memory and keeps its workers alive '
+                         'across evaluations')
+parser.add_argument('--prefetch_depth', type=int, default=2,
+                    help='--pipeline: batches staged ahead on the device, and batches whose metrics may be pending')
+parser.add_argument('--prefetch_factor', type=int, default=4,
+                    help='--pipeline: batches loaded in advance by each dataloader worker')
+parser.add_argument('--world_size', type=int, default=1,
+                    help='evaluate the test set in this many CPU processes (gloo), each on its own shard')
+parser.add_argument('--threads_per_process', type=int, default=None,
+                    help='intra-op threads of each process (default: cores / world_size)')
+parser.add_argument('--dist_port', type=int, default=29500, help='rendezvous port of the processes')
+parser.add_argument('--bucket_batch', action='store_true', default=False,
+                    help='bucket samples by neighbour count and pad the neighbours to a few fixed batch shapes')
+parser.add_argument('--scene_batch', action='store_true', default=False,
+                    help='batch the samples of a scene together and load every shared neighbour window once')
 net_args = parser.parse_args()
+if net_args.world_size > 1:
+    device = t.device("cpu")  # the processes share the CPU cores, see evaluateShard
+if net_args.num_workers is None:
+    net_args.num_workers = 8 // net_args.world_size
 
 
 
 class Evaluate():
-    def __init__(self):
+    def __init__(self, rank=0, world_size=1):
         self.op = 0
+        self.rank = rank
+        self.world_size = world_size
+        self.offset = 0
+        self.resume = 0  # batches done by an interrupted run
+        self.batches = None
+        self.datasets = {}  # kept across main() calls with --pipeline, with their DataLoaders
+        self.loaders = {}
     def main(self, val):
             model_step = 1
-            net = t.load('trained_models/SSTT_ngsim.pth')
-            net = net.to(device)
-            net.eval()
+            self.resume = 0  # set below when a --predictions_out store of an interrupted run is continued
+            # the test set is loaded in the background while the model is loaded
             if val:
                 if net_args.name=="ngsim":
-                    t2 = ngsimDataset(net_args.test_set)
-                valDataloader = DataLoader(t2, batch_size=net_args.batch_size, shuffle=False, num_workers=net_args.num_workers,
-                                           collate_fn=t2.collate_fn)
+                    t2 = self.dataset(net_args.test_set)
             else:
                 if net_args.dataset_name == "ngsim":
-                    t2 = ngsimDataset(net_args.test_set)
-                valDataloader = DataLoader(t2, batch_size=net_args.batch_size, shuffle=False, num_workers=net_args.num_workers,
-                                           collate_fn=t2.collate_fn)
+                    t2 = self.dataset(net_args.test_set)
+            reference = None
+            if net_args.sparse_spatial and (net_args.inference_backend != 'eager' or net_args.exported_model):
+                # the sparse attention replaces the blocks that prepareNet wraps and export.py captures
+                raise ValueError('--sparse_spatial runs the eager fp32 blocks and cannot be combined with '
+                                 '--inference_backend or --exported_model')
+            if net_args.sparse_spatial and net_args.profile:
+                # sparseSpatialBlock calls the attention layers directly, the module hooks would miss it
+                raise ValueError('--profile instruments the dense Net modules and cannot be combined with '
+                                 '--sparse_spatial')
+            if net_args.exported_model:
+                if net_args.decode_maneuver != 'all' or net_args.inference_backend != 'eager':
+                    raise ValueError('the --exported_model program decodes all maneuvers in fp32 and cannot be combined '
+                                     'with --decode_maneuver or --inference_backend')
+                net = loadExported(net_args.exported_model).to(device)
+                encoder_size = net_args.lstm_encoder_size
+            else:
+                net = loadModel(net_args.model, device)
+                encoder_size = net.encoder_size
+            if net_args.inference_backend != 'eager':
+                reference = net
+                net = prepareNet(net, net_args.inference_backend, net_args.compile_cache)
+            profiler = None
+            if net_args.profile:
+                if net_args.exported_model:
+                    raise ValueError('--profile instruments the Net modules and cannot be combined with --exported_model')
+                profiler = ModuleProfiler(net, net_args.profile_dir).start()
+            writer = None
+            if net_args.predictions_out:
+                out_dir = net_args.predictions_out
+                if self.world_size > 1:
+                    out_dir = os.path.join(out_dir, 'rank{}'.format(self.rank))
+                writer = PredictionWriter(out_dir, self.runMeta(), net_args.predictions_chunk)
+                if writer.state is not None:
+                    self.resume = writer.state['batches']
+            valDataloader = self.dataloader(t2)
             lossVals = t.zeros(net_args.out_length).to(device)
             counts = t.zeros(net_args.out_length).to(device)
+            refLossVals = t.zeros(net_args.out_length).to(device)
             avg_val_loss = 0
             all_time = 0
             nbrsss = 0
-            val_batch_count = len(valDataloader)
+            val_batch_count = len(valDataloader) + self.resume
+            metrics = None
+            if net_args.stratified_metrics or net_args.metrics_out:
+                metrics = StratifiedMetrics(net_args.out_length, device, num_lat_classes=net_args.num_lat_classes,
+                                            num_lon_classes=net_args.num_lon_classes)
+                traffic = t.as_tensor(t2.trafficLevels(), device=device)
+            sample = self.offset + self.resume * net_args.batch_size  # batches are sequential, shuffle=False
+            if self.resume:
+                state = writer.state
+                lossVals += state['lossVals'].to(device)
+                counts += state['counts'].to(device)
+                refLossVals += state['refLossVals'].to(device)
+                avg_val_loss, all_time, nbrsss = state['avg_val_loss'], state['all_time'], state['nbrsss']
+                if metrics is not None:
+                    metrics.merge(state['metrics'])
+                print('resuming {} after batch {}'.format(writer.out_dir, self.resume))
+
+            def evaluationState(batches, all_time, nbrsss):
+                return {'batches': batches, 'lossVals': lossVals.cpu(), 'counts': counts.cpu(),
+                        'refLossVals': refLossVals.cpu(), 'avg_val_loss': avg_val_loss, 'all_time': all_time,
+                        'nbrsss': nbrsss, 'metrics': metrics.state_dict() if metrics is not None else None}
+            # the NLL needs the whole maneuver mixture
+            single_maneuver = net_args.decode_maneuver != 'all' and net_args.val_use_mse and not net_args.train_flag
             print("begin.................................\n")
+            worker = None
+            batches = valDataloader
+            stage = functools.partial(self.stage, encoder_size=encoder_size, non_blocking=net_args.pipeline)
+            if net_args.pipeline:
+                # the next batches are staged on the device and the metrics of the last one are reduced while
+                # the model runs
+                worker = SerialWorker(net_args.prefetch_depth)
+                batches = Prefetcher(valDataloader, stage, device, net_args.prefetch_depth)
+
+            def finishBatch(idx, batch_index, fut_pred, lat_pred, lon_pred, ref_pred, lat_enc, lon_enc, fut, op_mask,
+                            all_time, nbrsss):
+                nonlocal lossVals, counts, refLossVals, avg_val_loss
+                l, c, loss = self.losses(fut_pred, lat_pred, lon_pred, lat_enc, lon_enc, fut, op_mask, single_maneuver)
+                if ref_pred is not None:
+                    refLossVals += self.losses(*ref_pred, lat_enc, lon_enc, fut, op_mask, single_maneuver)[0]
+                lossVals += l.detach()
+                counts += c.detach()
+                if metrics is not None:
+                    self.updateMetrics(metrics, traffic[batch_index.to(device)], fut_pred, lat_pred, lon_pred,
+                                       lat_enc, lon_enc, fut, op_mask)
+                avg_val_loss += loss.item()
+                if writer is not None:
+                    writer.append(t2.sampleKeys(batch_index.numpy()), fut_pred, lat_pred, lon_pred)
+                    if writer.isFull():
+                        writer.flush(evaluationState(self.resume + idx + 1, all_time, nbrsss))
+            te_wall = time.time()
             with(t.no_grad()):
-                for idx, data in enumerate(tqdm(valDataloader)):
-                    hist, nbrs, mask, lat_enc, lon_enc, fut, op_mask, va, nbrsva, lane, nbrslane, dis, nbrsdis, cls, nbrscls, map_positions= data
-                    hist = hist.to(device)
-                    nbrs = nbrs.to(device)
-                    mask = mask.to(device)
-                    lat_enc = lat_enc.to(device)
-                    lon_enc = lon_enc.to(device)
-                    fut = fut[:net_args.out_length, :, :]
-                    fut = fut.to(device)
-                    op_mask = op_mask[:net_args.out_length, :, :]
-                    op_mask = op_mask.to(device)
-                    va = va.to(device)
-                    nbrsva = nbrsva.to(device)
-                    cls = cls.to(device)
-                    nbrscls = nbrscls.to(device)
-                    te = time.time()
-                    fut_pred, lat_pred, lon_pred = net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
-                    all_time += time.time() - te
-                    nbrsss += 1
-                    if not net_args.train_flag:
-                        indices = []
-                        if net_args.val_use_mse:
-                            fut_pred_max = t.zeros_like(fut_pred[0])
-                            for k in range(lat_pred.shape[0]):  # 128
-                                lat_man = t.argmax(lat_enc[k, :]).detach()
-                                lon_man = t.argmax(lon_enc[k, :]).detach()
-                                index = lon_man * 3 + lat_man
-                                indices.append(index)
-                                fut_pred_max[:, k, :] = fut_pred[index][:, k, :]
-                            l, c, loss = self.maskedMSETest(fut_pred_max, fut, op_mask)
-                        else:
-                            l, c, loss = self.maskedNLLTest(fut_pred, lat_pred, lon_pred, fut, op_mask,
-                                                            use_maneuvers=net_args.use_maneuvers)
-                    else:
-                        if net_args.val_use_mse:
-                            l, c, loss = self.maskedMSETest(fut_pred, fut, op_mask)
+                try:
+                    for idx, data in enumerate(tqdm(batches, disable=self.rank > 0)):
+                        if worker is None:
+                            data = stage(data)
+                        hist, nbrs, mask, lat_enc, lon_enc, fut, op_mask, va, nbrsva, cls, nbrscls, nbr_cells, \
+                            batch_index = data
+                        if net_args.bucket_batch:
+                            batch_index = t.as_tensor(self.batches[idx])
+                        elif not net_args.scene_batch:
+                            batch_index = t.arange(sample, sample + hist.shape[1])
+                            sample += hist.shape[1]
+                        # pipelined, the forward pass isn't synchronized: on CUDA only its host side is timed
+                        if device.type == 'cuda' and worker is None:
+                            t.cuda.synchronize()  # time the forward pass only, not the queued copies
+                        te = time.time()
+                        fut_pred, lat_pred, lon_pred = self.predict(net, single_maneuver, hist, nbrs, mask, va, nbrsva,
+                                                                    cls, nbrscls, lat_enc, lon_enc, nbr_cells)
+                        if device.type == 'cuda' and worker is None:
+                            t.cuda.synchronize()
+                        all_time += time.time() - te
+                        nbrsss += 1
+                        if profiler is not None:
+                            profiler.record(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+                            if nbrsss == net_args.profile_batches:
+                                profiler.stop(all_time)
+                                profiler = None
+                        ref_pred = None
+                        if reference is not None:
+                            ref_pred = self.predict(reference, single_maneuver, hist, nbrs, mask, va, nbrsva, cls,
+                                                    nbrscls, lat_enc, lon_enc, nbr_cells)
+                        if worker is None:
+                            finishBatch(idx, batch_index, fut_pred, lat_pred, lon_pred, ref_pred, lat_enc, lon_enc, fut,
+                                        op_mask, all_time, nbrsss)
                         else:
-                            l, c, loss = self.maskedNLLTest(fut_pred, lat_pred, lon_pred, fut, op_mask,
-                                                            use_maneuvers=net_args.use_maneuvers)
-                    lossVals += l.detach()
-                    counts += c.detach()
-                    avg_val_loss += loss.item()
-                    if idx == int(val_batch_count / 4) * model_step:
-                        print('process:', model_step / 4)
-                        model_step += 1
+                            worker.submit(finishBatch, idx, batch_index, fut_pred, lat_pred, lon_pred, ref_pred,
+                                          lat_enc, lon_enc, fut, op_mask, all_time, nbrsss)
+                        if idx == int(val_batch_count / 4) * model_step:
+                            print('process:', model_step / 4)
+                            model_step += 1
+                finally:
+                    if worker is not None:
+                        worker.close()
+                if worker is not None and self.rank == 0:
+                    print('pipelined loop: {:.1f} s, {:.1f} batches/s'.format(
+                        time.time() - te_wall, len(valDataloader) / (time.time() - te_wall)))
+                if profiler is not None:  # fewer batches than --profile_batches
+                    profiler.stop(all_time)
+                if writer is not None:
+                    writer.flush(evaluationState(val_batch_count, all_time, nbrsss))
+                if self.world_size > 1:
+                    totals = t.tensor([avg_val_loss, val_batch_count, all_time, nbrsss], dtype=t.float64)
+                    allReduceSum(lossVals, counts, refLossVals, totals)
+                    if metrics is not None:
+                        allReduceSum(*[getattr(metrics, name) for name in SUMS])
+                    avg_val_loss, val_batch_count, all_time, nbrsss = totals.tolist()
+                    if self.rank > 0:
+                        return
+                    print("{} processes: {:.1f} s, {:.0f} samples/s".format(
+                        self.world_size, time.time() - te_wall, len(t2) / (time.time() - te_wall)))
             # tqdm.write('valmse:', avg_val_loss / val_batch_count)
                 if net_args.val_use_mse:
                     print('valmse:', avg_val_loss / val_batch_count* 0.3048)
                     print(t.pow(lossVals / counts, 0.5) * 0.3048)  # Calculate RMSE and convert from feet to meters
-                    print(all_time / nbrsss, "ref time")
+                    if worker is not None and device.type == 'cuda':
+                        print(all_time / nbrsss, "host time of the unsynchronized forward pass")
+                    else:
+                        print(all_time / nbrsss, "ref time")
                     rmseOverall = (t.pow(lossVals / counts, 0.5) * 0.3048).cpu()
                     pred_rmse_horiz = horiz_eval(rmseOverall, 5)
                     print("RMSE(m)\t=>{}".format(pred_rmse_horiz))
@@ -138,6 +307,148 @@ class Evaluate():
                     print('valnll:', avg_val_loss / val_batch_count)
                     print(lossVals / counts)
                     print(lossVals/counts*0.3048)
+                if reference is not None:
+                    self.reportBackendDelta(lossVals, refLossVals, counts)
+                if metrics is not None:
+                    if net_args.stratified_metrics:
+                        metrics.report()
+                    if net_args.metrics_out:
+                        t.save(metrics.state_dict(), net_args.metrics_out)
+
+    ## Loader batch as model inputs on the device: hist, nbrs, mask, lat_enc, lon_enc, fut, op_mask, va, nbrsva,
+    ## cls, nbrscls, nbr_cells and batch_index (None unless the batch carries the sample indices, --scene_batch)
+    def stage(self, data, encoder_size, non_blocking=False):
+        to = functools.partial(toDevice, device=device, non_blocking=non_blocking)
+        nbr_cells = None
+        batch_index = None
+        if net_args.scene_batch:
+            positions, features, ego_index, ref, nbr_index, nbr_unique, lat_enc, lon_enc, fut, op_mask, \
+                batch_index = data
+            hist, nbrs, nbr_index, occupancy, va, lane, dis, cls = expandScene(
+                to(positions), to(features), to(ego_index), to(ref), to(nbr_index), to(nbr_unique),
+                tuple(net_args.grid_size))
+            nbrs, nbrsva, nbrslane, nbrsdis, nbrscls, mask, map_positions = unpackNeighbors(
+                nbrs, nbr_index, occupancy, encoder_size)
+        elif net_args.packed_batch or net_args.bucket_batch:
+            hist, nbrs, nbr_index, occupancy, lat_enc, lon_enc, fut, op_mask, va, lane, dis, cls = data
+            nbrs, nbrsva, nbrslane, nbrsdis, nbrscls, mask, map_positions = unpackNeighbors(
+                to(nbrs), to(nbr_index), to(occupancy), encoder_size)
+            nbr_cells = neighborCells(to(nbr_index), hist.shape[1])  # no mask scatter, see forwardPacked
+        else:
+            hist, nbrs, mask, lat_enc, lon_enc, fut, op_mask, va, nbrsva, lane, nbrslane, dis, nbrsdis, cls, nbrscls, \
+                map_positions = data
+        hist, nbrs, mask, lat_enc, lon_enc, va, nbrsva, cls, nbrscls = to((hist, nbrs, mask, lat_enc, lon_enc, va,
+                                                                          nbrsva, cls, nbrscls))
+        fut = to(fut[:net_args.out_length, :, :])
+        op_mask = to(op_mask[:net_args.out_length, :, :])
+        return hist, nbrs, mask, lat_enc, lon_enc, fut, op_mask, va, nbrsva, cls, nbrscls, nbr_cells, batch_index
+
+    ## Arguments that determine the batches and predictions, a resumed --predictions_out run must match them
+    def runMeta(self):
+        names = ('test_set', 'model', 'exported_model', 'batch_size', 'in_length', 'out_length', 'grid_size',
+                 'num_lat_classes', 'num_lon_classes', 'train_flag', 'use_maneuvers', 'decode_maneuver',
+                 'inference_backend', 'sparse_spatial', 'packed_batch', 'bucket_batch', 'scene_batch', 'sample_cache',
+                 'cache_dir', 'track_store', 'val_use_mse', 'stratified_metrics', 'metrics_out', 'world_size')
+        return dict((name, getattr(net_args, name)) for name in names)
+
+    ## nbr_cells: grid cells of the neighbour rows of a packed (--packed_batch, --bucket_batch) batch
+    def predict(self, net, single_maneuver, hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc, nbr_cells=None):
+        if net_args.exported_model:  # ExportableNet inputs, always all maneuvers
+            return net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, maskCells(mask) if nbr_cells is None else nbr_cells)
+        if net_args.sparse_spatial and nbr_cells is None:
+            nbr_cells = maskCells(mask)
+        if single_maneuver or nbr_cells is not None:
+            return forwardManeuver(net, hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc,
+                                   net_args.decode_maneuver if single_maneuver else 'all', nbr_cells,
+                                   net_args.sparse_spatial)
+        return net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+
+    def losses(self, fut_pred, lat_pred, lon_pred, lat_enc, lon_enc, fut, op_mask, single_maneuver):
+        if not net_args.train_flag and net_args.val_use_mse and not single_maneuver:
+            fut_pred = selectManeuver(fut_pred, lat_enc, lon_enc)
+        if net_args.val_use_mse:
+            return self.maskedMSETest(fut_pred, fut, op_mask)
+        return self.maskedNLLTest(fut_pred, lat_pred, lon_pred, fut, op_mask, use_maneuvers=net_args.use_maneuvers)
+
+    ## Accuracy of the --inference_backend run against the fp32 eager model on the same batches
+    def reportBackendDelta(self, lossVals, refLossVals, counts):
+        print("{} against fp32 eager:".format(net_args.inference_backend))
+        if net_args.val_use_mse:
+            rmse = (t.pow(lossVals / counts, 0.5) * 0.3048).cpu()
+            ref_rmse = (t.pow(refLossVals / counts, 0.5) * 0.3048).cpu()
+            print("RMSE delta (m)\t=>{}".format(horiz_eval(rmse, 5) - horiz_eval(ref_rmse, 5)))
+            print("FDE delta (m)\t=> {}, Mean={:.5f}".format(rmse[4::5] - ref_rmse[4::5],
+                                                             (rmse[4::5] - ref_rmse[4::5]).mean()))
+        else:
+            print("NLL delta\t=> {}".format(((lossVals - refLossVals) / counts).cpu()))
+
+    ## Accumulates the stratified metrics of a batch, using the ground-truth maneuver's trajectory as point
+    ## prediction and the full maneuver mixture for the NLL
+    def updateMetrics(self, metrics, levels, fut_pred, lat_pred, lon_pred, lat_enc, lon_enc, fut, op_mask):
+        if isinstance(fut_pred, list):
+            point = selectManeuver(fut_pred, lat_enc, lon_enc)
+            nll = multiModalNLL(fut_pred, lat_pred, lon_pred, fut)
+        else:
+            point = fut_pred
+            nll = bivariateNLL(fut_pred, fut)
+        metrics.update(point, fut, op_mask, lat_enc, lon_enc, levels, nll)
+
+    ## DataLoader arguments of --pipeline: pinned batches for asynchronous host to device copies, and workers that
+    ## stay alive across evaluations with prefetch_factor batches queued each
+    def loaderArgs(self):
+        if not net_args.pipeline:
+            return {}
+        args = {'pin_memory': device.type == 'cuda'}
+        if net_args.num_workers > 0:
+            args.update(persistent_workers=True, prefetch_factor=net_args.prefetch_factor)
+        return args
+
+    ## With --pipeline, a later evaluation of the same dataset reuses the DataLoader and its worker processes
+    def dataloader(self, dataset):
+        key = (id(dataset), self.resume)
+        if key in self.loaders:
+            loader, self.offset, self.batches = self.loaders[key]
+            return loader
+        loader = self.newDataloader(dataset)
+        if net_args.pipeline:
+            self.loaders[key] = (loader, self.offset, self.batches)
+        return loader
+
+    def newDataloader(self, dataset):
+        if net_args.bucket_batch:
+            sampler = NeighborBucketSampler(dataset, net_args.batch_size)
+            # fixed order, to look up sample indices
+            self.batches = list(sampler)[self.rank::self.world_size][self.resume:]
+            return DataLoader(dataset, batch_sampler=self.batches, num_workers=net_args.num_workers,
+                              collate_fn=functools.partial(dataset.collate_fn_packed, nbr_capacities=sampler.capacities),
+                              **self.loaderArgs())
+        if net_args.scene_batch:
+            batches = SceneBatches(dataset, list(SceneBatchSampler(dataset, net_args.batch_size))[self.rank::self.world_size]
+                                   [self.resume:])
+            return DataLoader(batches, batch_size=None, shuffle=False, num_workers=net_args.num_workers,
+                              **self.loaderArgs())
+        shard = dataset
+        if self.world_size > 1 or self.resume:
+            self.offset, end = shardRange(len(dataset), self.rank, self.world_size)
+            shard = Subset(dataset, range(self.offset + self.resume * net_args.batch_size, end))
+        return DataLoader(shard, batch_size=net_args.batch_size, shuffle=False, num_workers=net_args.num_workers,
+                          collate_fn=dataset.collate_fn_packed if net_args.packed_batch else dataset.collate_fn,
+                          **self.loaderArgs())
+
+    def dataset(self, mat_file):
+        if mat_file in self.datasets:
+            return self.datasets[mat_file]
+        if net_args.scene_batch and net_args.sample_cache:
+            raise ValueError('--scene_batch reads the tracks and cannot be combined with --sample_cache')
+        if net_args.sample_cache:
+            dataset = ngsimCacheDataset(mat_file, grid_size=tuple(net_args.grid_size), cache_dir=net_args.cache_dir)
+        else:
+            dataset = ngsimDataset(mat_file, grid_size=tuple(net_args.grid_size), track_store=net_args.track_store,
+                                   lazy=True)
+        if net_args.pipeline:
+            self.datasets[mat_file] = dataset
+        return dataset
+
     def maskedMSETest(self, y_pred, y_gt, mask):
         acc = t.zeros_like(mask)
         muX = y_pred[:, :, 0]
@@ -153,43 +464,11 @@ class Evaluate():
         loss = t.sum(acc) / t.sum(mask)
         return lossVal, counts, loss
 
-    def logsumexp(self, inputs, dim=None, keepdim=False):
-        if dim is None:
-            inputs = inputs.view(-1)
-            dim = 0
-        s, _ = t.max(inputs, dim=dim, keepdim=True)
-        outputs = s + (inputs - s).exp().sum(dim=dim, keepdim=True).log()
-        if not keepdim:
-            outputs = outputs.squeeze(dim)
-        return outputs
-
     def maskedNLLTest(self, fut_pred, lat_pred, lon_pred, fut, op_mask, num_lat_classes=3, num_lon_classes=3,
                       use_maneuvers=True):
         if use_maneuvers:
-            acc = t.zeros(op_mask.shape[0], op_mask.shape[1], num_lon_classes * num_lat_classes).to(device)
-            count = 0
-            for k in range(num_lon_classes):
-                for l in range(num_lat_classes):
-                    wts = lat_pred[:, l] * lon_pred[:, k]
-                    wts = wts.repeat(len(fut_pred[0]), 1)
-                    y_pred = fut_pred[k * num_lat_classes + l]
-                    y_gt = fut
-                    muX = y_pred[:, :, 0]
-                    muY = y_pred[:, :, 1]
-                    sigX = y_pred[:, :, 2]
-                    sigY = y_pred[:, :, 3]
-                    rho = y_pred[:, :, 4]
-                    ohr = t.pow(1 - t.pow(rho, 2), -0.5)
-                    x = y_gt[:, :, 0]
-                    y = y_gt[:, :, 1]
-                    # If we represent likelihood in feet^(-1):
-                    out = -(0.5 * t.pow(ohr, 2) * (
-                            t.pow(sigX, 2) * t.pow(x - muX, 2) + 0.5 * t.pow(sigY, 2) * t.pow(
-                        y - muY, 2) - rho * t.pow(sigX, 1) * t.pow(sigY, 1) * (x - muX) * (
-                                    y - muY)) - t.log(sigX * sigY * ohr) + 1.8379)
-                    acc[:, :, count] = out + t.log(wts)
-                    count += 1
-            acc = -self.logsumexp(acc, dim=2)
+            # all 9 modes in one expression, (len, batch) NLL of the mixture
+            acc = multiModalNLL(fut_pred, lat_pred, lon_pred, fut)
             acc = acc * op_mask[:, :, 0]
             loss = t.sum(acc) / t.sum(op_mask[:, :, 0])
             lossVal = t.sum(acc, dim=1)
@@ -237,6 +516,27 @@ def horiz_eval(loss_total, n_horiz):
         avg_res[i] = np.mean(loss_total[st_id:en_id + 1])
 
     return avg_res
-if __name__ == '__main__':
-    evaluate = Evaluate()
+
+## Builds (or validates) the --sample_cache / --track_store files of the test set in the parent process, so
+## that the processes of a --world_size run only open them instead of all building them at once
+def buildStores():
+    if net_args.sample_cache:
+        ngsimCacheDataset(net_args.test_set, grid_size=tuple(net_args.grid_size), cache_dir=net_args.cache_dir)
+    elif net_args.track_store:
+        TrackStore.load(net_args.test_set, net_args.track_store)
+
+
+## One process of a --world_size run: evaluates its shard and all-reduces the sums to rank 0
+def evaluateShard(rank, world_size):
+    initProcessGroup(rank, world_size, net_args.dist_port, net_args.threads_per_process)
+    evaluate = Evaluate(rank, world_size)
     evaluate.main(val=False)
+
+
+if __name__ == '__main__':
+    if net_args.world_size > 1:
+        buildStores()
+        mp.spawn(evaluateShard, args=(net_args.world_size,), nprocs=net_args.world_size)
+    else:
+        evaluate = Evaluate()
+        evaluate.main(val=False)
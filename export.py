@@ -0,0 +1,60 @@
+from __future__ import print_function, division
+import argparse
+import time
+import numpy as np
+import torch as t
+from torch.utils.data import DataLoader
+from loader import ngsimDataset
+from inference import exportNet, loadExported, maskCells
+from checkpoint import loadModel
+
+parser = argparse.ArgumentParser(description='Exporting:')
+parser.add_argument('--model', type=str, default='trained_models/SSTT_ngsim.pth', help='model to export')
+parser.add_argument('--out', type=str, default='trained_models/SSTT_ngsim.pt2', help='exported program path')
+parser.add_argument('--test_set', type=str, default='data/ngsim/TestSet.mat', help='dataset for the equivalence check')
+parser.add_argument('--batch_size', type=int, default=256)
+parser.add_argument('--batches', type=int, default=0, help='batches compared (0: whole test set)')
+parser.add_argument('--atol', type=float, default=1e-5, help='largest accepted difference to the eager model')
+
+
+def inputs(data):
+    hist, nbrs, mask, _, _, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = data
+    return hist, nbrs, mask, va, nbrsva, cls, nbrscls, maskCells(mask)
+
+
+## Largest absolute difference of the trajectories and maneuver probabilities of the exported program to the
+## eager model, and the per-batch latency of both
+def compare(net, exported, dataloader, batches):
+    max_diff = 0.0
+    times = {'eager': [], 'exported': []}
+    with t.no_grad():
+        for idx, data in enumerate(dataloader):
+            if batches and idx == batches:
+                break
+            hist, nbrs, mask, lat_enc, lon_enc, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = data
+            te = time.perf_counter()
+            ref = net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+            times['eager'].append(time.perf_counter() - te)
+            te = time.perf_counter()
+            out = exported(*inputs(data))
+            times['exported'].append(time.perf_counter() - te)
+            for a, b in zip(list(ref[0]) + list(ref[1:]), list(out[0]) + list(out[1:])):
+                max_diff = max(max_diff, (a - b).abs().max().item())
+    return max_diff, times
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    net = loadModel(args.model)
+    dataset = ngsimDataset(args.test_set)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, collate_fn=dataset.collate_fn)
+    te = time.perf_counter()
+    t.export.save(exportNet(net, inputs(next(iter(dataloader)))), args.out)
+    print('saved {} ({:.1f} s)'.format(args.out, time.perf_counter() - te))
+    max_diff, times = compare(net, loadExported(args.out), dataloader, args.batches)
+    for name in ('eager', 'exported'):
+        print('{:<10} latency p50 {:.2f} ms, p95 {:.2f} ms'.format(name, np.percentile(times[name], 50) * 1000,
+                                                                 np.percentile(times[name], 95) * 1000))
+    print('{} batches, max abs difference to the eager model: {:.3g}'.format(len(times['eager']), max_diff))
+    if max_diff > args.atol:
+        raise SystemExit('exported program differs from the eager model by more than {}'.format(args.atol))
@@ -0,0 +1,234 @@
+from __future__ import print_function, division
+import copy
+import os
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from loader import unpackNeighbors
+
+INFERENCE_BACKENDS = ('eager', 'compile', 'bf16')
+
+
+## The stages of Net.forward as separate steps, with the same operations in the same order so that every
+## stage gives exactly the tensors of the full forward pass.
+
+## Flat social grid index (sample * 39 + cell) of every neighbour row of a packed batch, padding rows
+## (nbr_index -1) point to one spare slot past the grid
+def neighborCells(nbr_index, batch_size, grid_cells=39):
+    return torch.where(nbr_index[:, 0] >= 0, nbr_index[:, 0] * grid_cells + nbr_index[:, 1], batch_size * grid_cells)
+
+
+## Flat social grid index of the occupied cells of a social mask, in the order masked_scatter_ fills them
+def maskCells(mask):
+    return torch.nonzero(mask[..., 0].reshape(-1)).squeeze(1)
+
+
+## Bias of a Linear layer; dynamic quantized Linear layers (quantize.py) return it from a method
+def linearBias(linear):
+    bias = linear.bias
+    return bias() if callable(bias) else bias
+
+
+## SparseSpatialAttention over the occupied grid cells only. The dense module attends over all 39 cells of a
+## sample; an empty cell holds a zero encoding, so its key and value are the linear_k / linear_v biases and all
+## empty cells of a sample share one score, one gate and one value. Their softmax and weighted sum are therefore
+## num_empty times that of a single empty cell, and only the neighbours' keys and values are computed.
+## x: (batch, in_length, D) ego encodings, nbrs_enc: (in_length, neighbours, D), samples: (neighbours,) sample
+## of each neighbour (padding rows: batch), num_empty: (batch,) empty cells per sample.
+def sparseSpatialAttention(attn, x, nbrs_enc, samples, num_empty):
+    batch_size = x.size(0)
+    query = attn.linear_q(x).transpose(0, 1)  # (in_length, batch, E)
+    keys = attn.linear_k(nbrs_enc)
+    values = attn.linear_v(nbrs_enc)
+    query = torch.cat((query, query.new_zeros(query.size(0), 1, query.size(2))), 1)  # padding sample
+    scores = (query[:, samples] * keys).sum(-1) * attn._norm_fact  # (in_length, neighbours)
+    empty = torch.matmul(query, linearBias(attn.linear_k)) * attn._norm_fact  # (in_length, batch + 1)
+    # softmax over each sample's neighbours and empty cells
+    top = empty.scatter_reduce(1, samples.expand_as(scores), scores, 'amax')
+    scores = torch.exp(scores - top[:, samples])
+    empty = torch.exp(empty - top)
+    total = (empty * num_empty).index_add(1, samples, scores)
+    scores = scores / total[:, samples]
+    empty = empty / total
+    # the gate is a 1x1 convolution over the in_length attention weights of each cell
+    weights = torch.cat((scores, empty), 1).t()
+    gate = attn.sigmoid(attn.conv2d(weights.reshape(weights.size(0), weights.size(1), 1, 1))).view_as(weights).t()
+    gate = torch.where(gate < attn.kesi, torch.zeros_like(gate), gate)
+    scores = scores * gate[:, :scores.size(1)]
+    empty = empty * gate[:, scores.size(1):] * num_empty
+    out = (empty.unsqueeze(2) * linearBias(attn.linear_v)).index_add(1, samples, scores.unsqueeze(2) * values)
+    return attn.fc_o(out[:, :batch_size].transpose(0, 1))
+
+
+## SparseSpatialTransformer with sparseSpatialAttention
+def sparseSpatialBlock(block, x, nbrs_enc, samples, num_empty):
+    x1 = block.add_and_norm(sparseSpatialAttention(block.sparse_spatial_attn, x, nbrs_enc, samples, num_empty), x)
+    return block.add_and_norm(block.ff(x1), x1)
+
+
+## Encoder and spatial-temporal blocks: (batch, in_length, encoder_size) encoding. With nbr_cells (see
+## neighborCells) the neighbour encodings are written to their grid cells by index instead of masked_scatter_,
+## which reads them in order and so needs exactly as many rows as the mask has cells; this lets the neighbour
+## tensor carry padding rows. Both give the same grid. sparse_spatial (needs nbr_cells) runs the spatial
+## attention on the neighbours without building the grid, see sparseSpatialAttention.
+def encode(net, hist, nbrs, mask, va, nbrsva, cls, nbrscls, nbr_cells=None, sparse_spatial=False):
+    hist = torch.cat((hist, cls, va), -1)
+    nbrs = torch.cat((nbrs, nbrscls, nbrsva), -1)
+    hist_enc, _ = net.enc_lstm(net.leaky_relu(net.linear_motion(hist)))
+    hist_enc = hist_enc.permute(1, 0, 2)
+    nbrs_enc, _ = net.enc_lstm(net.leaky_relu(net.linear_motion(nbrs)))
+    mask = mask.view(mask.size(0), mask.size(1) * mask.size(2), mask.size(3))
+    if sparse_spatial:
+        samples = nbr_cells // mask.size(1)  # padding rows -> batch
+        num_empty = mask.size(1) - torch.bincount(samples, minlength=mask.size(0) + 1)
+    elif nbr_cells is None:
+        mask = mask.unsqueeze(0).expand(net.in_length, -1, -1, -1)
+        soc_enc = torch.zeros_like(mask).float()
+        soc_enc = soc_enc.masked_scatter_(mask, nbrs_enc)
+    else:
+        cells = mask.size(0) * mask.size(1)
+        soc_enc = nbrs_enc.new_zeros(nbrs_enc.size(0), cells + 1, nbrs_enc.size(2))
+        soc_enc[:, nbr_cells] = nbrs_enc
+        soc_enc = soc_enc[:, :cells].view(nbrs_enc.size(0), mask.size(0), mask.size(1), nbrs_enc.size(2))
+    if not sparse_spatial:
+        soc_enc = soc_enc.permute(1, 0, 2, 3)
+    spatial_list = []
+    temporal_list = []
+    for i in range(net.blocks):
+        if sparse_spatial:
+            spatial = sparseSpatialBlock(net.sparse_spatial[i], hist_enc, nbrs_enc, samples, num_empty)
+        else:
+            spatial, _ = net.sparse_spatial[i](hist_enc, soc_enc)
+        temporal, _ = net.casual_sparse_temporal[i](spatial)
+        spatial_list.append(spatial)
+        temporal_list.append(temporal)
+    spatial = torch.stack(spatial_list)
+    temporal = torch.stack(temporal_list)
+    num_blocks, B, T, D = spatial.shape
+    spatial = spatial.permute(1, 2, 0, 3).reshape(B, T, num_blocks * D)
+    temporal = temporal.permute(1, 2, 0, 3).reshape(B, T, num_blocks * D)
+    return net.addnorm(temporal, spatial)
+
+
+## Lateral and longitudinal maneuver probabilities (batch, 3) from the encoding
+def maneuverHeads(net, enc):
+    maneuver_state = net.activation(net.mu_fc1(enc[:, -1, :]))
+    maneuver_state = net.activation(net.normalize(net.mu_fc(maneuver_state)))
+    return F.softmax(net.op_lat(maneuver_state), dim=-1), F.softmax(net.op_lon(maneuver_state), dim=-1)
+
+
+## Trajectory (out_length, batch, 5) conditioned on one one-hot maneuver per sample
+def decodeManeuver(net, enc, lat_enc, lon_enc):
+    index = torch.cat((lat_enc, lon_enc), dim=-1).transpose(1, 0)
+    mapping = F.softmax(torch.matmul(net.mapping, index).permute(2, 1, 0), dim=-1)
+    dec = torch.matmul(mapping, enc).permute(1, 0, 2)
+    return net.decode(dec, lat_enc, lon_enc)
+
+
+## Decodes only one maneuver per sample instead of all nine: the ground-truth maneuver (lat_enc / lon_enc)
+## for maneuver='true', the most likely predicted one for maneuver='pred'. The trajectory is the one Net.forward
+## returns at index lon * 3 + lat of its list. maneuver='all' returns that whole list (for the NLL) like
+## Net.forward in evaluation mode.
+def forwardManeuver(net, hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc, maneuver='true', nbr_cells=None,
+                    sparse_spatial=False):
+    enc = encode(net, hist, nbrs, mask, va, nbrsva, cls, nbrscls, nbr_cells, sparse_spatial)
+    lat_pred, lon_pred = maneuverHeads(net, enc)
+    if maneuver == 'all':
+        fut_pred = []
+        for k in range(net.num_lon_classes):
+            for l in range(net.num_lat_classes):
+                lat_enc_tmp = torch.zeros_like(lat_pred)
+                lon_enc_tmp = torch.zeros_like(lon_pred)
+                lat_enc_tmp[:, l] = 1
+                lon_enc_tmp[:, k] = 1
+                fut_pred.append(decodeManeuver(net, enc, lat_enc_tmp, lon_enc_tmp))
+        return fut_pred, lat_pred, lon_pred
+    if maneuver == 'pred':
+        lat_enc = torch.zeros_like(lat_pred).scatter_(1, torch.argmax(lat_pred, dim=-1, keepdim=True), 1)
+        lon_enc = torch.zeros_like(lon_pred).scatter_(1, torch.argmax(lon_pred, dim=-1, keepdim=True), 1)
+    return decodeManeuver(net, enc, lat_enc, lon_enc), lat_pred, lon_pred
+
+
+## Net outputs for a collate_fn_packed batch, which may be padded to a capacity (see NeighborBucketSampler):
+## the packed neighbour tensor is split into views, the social mask is an expanded view of the occupancy map,
+## and the neighbour encodings are written to their grid cells by index (neighborCells), so neither the dense
+## neighbour tensors nor the (batch, 3, 13, enc_size) mask are built. maneuver as in forwardManeuver.
+def forwardPacked(net, hist, nbrs, nbr_index, occupancy, va, cls, lat_enc, lon_enc, maneuver='all',
+                  sparse_spatial=False):
+    nbrs, nbrsva, _, _, nbrscls, mask, _ = unpackNeighbors(nbrs, nbr_index, occupancy, net.encoder_size)
+    return forwardManeuver(net, hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc, maneuver,
+                           neighborCells(nbr_index, hist.shape[1]), sparse_spatial)
+
+
+## Casts the (tuple of) bf16 outputs of an autocast region back to fp32 for the following fp32 layers
+def toFloat(out):
+    if isinstance(out, tuple):
+        return tuple(toFloat(o) for o in out)
+    return out.float() if torch.is_tensor(out) and out.is_floating_point() else out
+
+
+## Runs fn under bf16 autocast of the device its tensor arguments are on (CPU or CUDA)
+def bf16Autocast(fn):
+    def forward(*args, **kwargs):
+        device = next((a.device.type for a in args if torch.is_tensor(a)), 'cpu')
+        with torch.autocast(device, dtype=torch.bfloat16):
+            return toFloat(fn(*args, **kwargs))
+    return forward
+
+
+## Copy of net for the given backend; 'compile' and 'bf16' apply to the spatial and temporal transformer
+## blocks and the decoder, which dominate the run time, while the encoder LSTM and the maneuver loop stay
+## eager fp32. Wrapping the stages (instead of Net.forward) keeps them in effect for forwardManeuver as well.
+## Inductor's FX graph cache (where torch has it) is kept in cache_dir (if given) so later runs skip recompilation.
+def prepareNet(net, backend='eager', cache_dir=None):
+    if backend == 'eager':
+        return net
+    if backend == 'compile':
+        if cache_dir:
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+        import torch._inductor.config
+        if hasattr(torch._inductor.config, 'fx_graph_cache'):  # not in every torch release
+            torch._inductor.config.fx_graph_cache = True
+        wrap = torch.compile
+    elif backend == 'bf16':
+        wrap = bf16Autocast
+    else:
+        raise ValueError('unknown inference backend: {}'.format(backend))
+    net = copy.deepcopy(net)
+    for module in list(net.sparse_spatial) + list(net.casual_sparse_temporal):
+        module.forward = wrap(module.forward)
+    net.decode = wrap(net.decode)
+    return net
+
+
+## Net in evaluation mode as a graph that torch.export can capture: the stages above replace the einops
+## repeat of Net.forward (whose sizes would be baked in) and masked_scatter_ (nbr_cells, see maskCells and
+## neighborCells), so the batch and neighbour axes stay dynamic. Returns the 9 maneuver trajectories in
+## Net.forward's order and the maneuver probabilities.
+class ExportableNet(nn.Module):
+
+    def __init__(self, net):
+        super(ExportableNet, self).__init__()
+        self.net = net
+
+    def forward(self, hist, nbrs, mask, va, nbrsva, cls, nbrscls, nbr_cells):
+        lat_enc = hist.new_zeros(hist.size(1), self.net.num_lat_classes)
+        lon_enc = hist.new_zeros(hist.size(1), self.net.num_lon_classes)
+        return forwardManeuver(self.net, hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc, 'all', nbr_cells)
+
+
+## ExportedProgram of net for inputs like example_inputs (hist, nbrs, mask, va, nbrsva, cls, nbrscls, nbr_cells),
+## with a dynamic batch and neighbour axis
+def exportNet(net, example_inputs):
+    batch = torch.export.Dim('batch', min=1, max=2 ** 16)
+    neighbors = torch.export.Dim('neighbors', min=0, max=2 ** 22)
+    dynamic_shapes = ({1: batch}, {1: neighbors}, {0: batch}, {1: batch}, {1: neighbors}, {1: batch},
+                      {1: neighbors}, {0: neighbors})
+    with torch.no_grad():
+        return torch.export.export(ExportableNet(net.eval()), tuple(example_inputs), dynamic_shapes=dynamic_shapes)
+
+
+## Callable module of a saved ExportedProgram; the graph and weights are self-contained, the model code is not
+## imported
+def loadExported(path):
+    return torch.export.load(path).module()
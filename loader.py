@@ -1,15 +1,110 @@
 from __future__ import print_function, division
-from torch.utils.data import Dataset
-import scipy.io as scp
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import Dataset, Sampler
 import numpy as np
 import torch
 import time
+from track_store import TrackStore
+
+EMPTY1 = np.empty([0, 1])
+EMPTY2 = np.empty([0, 2])
+
+
+TRAFFIC_LEVELS = ('light', 'moderate', 'heavy')
+
+
+## Vectorized get_different_traffic over the (samples, 39) grid ids: 0 (<= 5 distinct neighbours),
+## 1 (6 to 10) or 2 (more than 10)
+def trafficLevels(grid):
+    grid = np.sort(grid, axis=1)
+    nbrs_num = np.count_nonzero(np.diff(grid, axis=1), axis=1)  # distinct ids - 1
+    return np.digitize(nbrs_num, [6, 11]).astype(np.int64)
+
+
+GRID_RANGE = 90.0  # ft ahead / behind covered by the 13 x 3 grid
+CELL_LENGTH = 15.0  # ft
+
+
+## Grid cell (0..38) of a neighbour at lane offset dl and longitudinal offset dy, -1 outside the 13 x 3 grid.
+## Same rule as the NGSIM preprocessing: columns are the left / same / right lane, rows 15 ft apart.
+def gridCell(dl, dy):
+    cell = (dl + 1) * 13 + np.floor((dy + GRID_RANGE) / CELL_LENGTH + 0.5).astype(int)
+    return np.where((np.abs(dl) <= 1) & (np.abs(dy) < GRID_RANGE), cell, -1)
+
+
+## Channels of the packed neighbour tensor built by collate_fn_packed
+NBR_FEATURES = ('x', 'y', 'v', 'a', 'lane', 'distance', 'class')
+
+
+## collate_fn_packed neighbours -> (nbrs, nbrsva, nbrslane, nbrsdis, nbrscls, mask, map_position) as returned
+## by collate_fn. The social mask is an expanded view of the occupancy map, so it costs no extra memory.
+def unpackNeighbors(nbrs, nbr_index, occupancy, enc_size=64):
+    grid_width = occupancy.shape[2]
+    mask = occupancy.unsqueeze(3).expand(-1, -1, -1, enc_size)
+    map_position = torch.stack((nbr_index[:, 1] // grid_width, nbr_index[:, 1] % grid_width), 1).float()
+    return nbrs[:, :, 0:2], nbrs[:, :, 2:4], nbrs[:, :, 4:5], nbrs[:, :, 5:6], nbrs[:, :, 6:7], mask, map_position
+
+
+## collate_fn_scene batch -> (hist, nbrs, nbr_index, occupancy, va, lane, distance, class) in the
+## collate_fn_packed layout: every unique window is copied once and gathered here (e.g. on the device) for
+## each ego and (ego, grid cell). Positions stay float64 up to the subtraction of the ego's reference
+## position, so the result is identical to collate_fn_packed.
+def expandScene(positions, features, ego_index, ref, nbr_index, nbr_unique, grid_size=(13, 3)):
+    valid = (ego_index >= 0).unsqueeze(1)
+    ego = ego_index.clamp(min=0)
+    hist = (positions[:, ego] - ref) * valid
+    nbr_hist = positions[:, nbr_unique] - ref[nbr_index[:, 0]]
+    uu = torch.pow(hist[:, nbr_index[:, 0]] - nbr_hist, 2)
+    distance = torch.sqrt(uu[:, :, 0] + uu[:, :, 1]).unsqueeze(2)
+    ego_features = features[:, ego] * valid
+    nbr_features = features[:, nbr_unique]
+    nbrs = torch.cat((nbr_hist.float(), nbr_features[:, :, 0:3], distance.float(), nbr_features[:, :, 3:4]), 2)
+    occupancy = torch.zeros(len(ego_index), grid_size[1], grid_size[0], dtype=torch.bool, device=ego_index.device)
+    occupancy[nbr_index[:, 0], nbr_index[:, 1] // grid_size[0], nbr_index[:, 1] % grid_size[0]] = True
+    lane = ego_features[:, :, 2:3]
+    return hist.float(), nbrs, nbr_index, occupancy, ego_features[:, :, 0:2], lane, torch.zeros_like(lane), \
+        ego_features[:, :, 3:4]
+
+
+## Smallest of the capacities that holds n neighbours (n itself without capacities or if none is large enough)
+def padCapacity(n, capacities=None):
+    for capacity in capacities or ():
+        if capacity >= n:
+            return capacity
+    return n
+
+
+## Writes arrays of shape (len, ...) side by side into the first columns of out (maxlen, >= n, ...), zero padding
+## shorter ones
+def stackInto(out, arrays):
+    if len(arrays) == 0:
+        return out
+    if all(len(a) == out.shape[0] for a in arrays):
+        np.stack(arrays, axis=1, out=out[:, :len(arrays)], casting='same_kind')
+        return out
+    for i, a in enumerate(arrays):
+        out[:len(a), i] = a
+    return out
+
+
+def loadTracks(mat_file, track_store=None):
+    return TrackStore.read(mat_file) if track_store is None else TrackStore.load(mat_file, track_store)
+
 
 class ngsimDataset(Dataset):
 
-    def __init__(self, mat_file, t_h=30, t_f=50, d_s=2, enc_size=64, grid_size=(13, 3)):
-        self.D = scp.loadmat(mat_file)['traj']
-        self.T = scp.loadmat(mat_file)['tracks']
+    def __init__(self, mat_file, t_h=30, t_f=50, d_s=2, enc_size=64, grid_size=(13, 3), track_store=None,
+                 lazy=False):
+        # track_store: directory of a memory-mapped TrackStore shared by all DataLoader workers (built on first
+        # use), otherwise the tracks are converted to the same columnar layout in memory
+        # lazy: the tracks are loaded in a background thread and the first access to self.tracks waits for them,
+        # so that e.g. the model can be loaded and moved to the device in the meantime
+        if lazy:
+            executor = ThreadPoolExecutor(1)
+            self.loading = executor.submit(loadTracks, mat_file, track_store)
+            executor.shutdown(wait=False)
+        else:
+            self.tracks = loadTracks(mat_file, track_store)
         self.t_h = t_h  #
         self.t_f = t_f  #
         self.d_s = d_s  # skip
@@ -18,6 +113,25 @@ class ngsimDataset(Dataset):
         self.alltime = 0
         self.count = 0
 
+    ## Only called while self.tracks is not set, i.e. until the lazy load is done
+    def __getattr__(self, name):
+        if name != 'tracks' or 'loading' not in self.__dict__:
+            raise AttributeError(name)
+        self.tracks = self.loading.result()
+        return self.tracks
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if 'loading' in state:  # futures don't pickle
+            del state['loading']
+            state['tracks'] = self.tracks
+        return state
+
+    ## 'traj' sample table, part of the track store so that it is shared (and pickled by path) the same way
+    @property
+    def D(self):
+        return self.tracks.traj
+
     def __len__(self):
         return len(self.D)
 
@@ -27,157 +141,120 @@ class ngsimDataset(Dataset):
         vehId = self.D[idx, 1].astype(int)  # agent id
         t = self.D[idx, 2]  # frame
         grid = self.D[idx, 11:]  #  grid id
-        neighbors = []
-        neighborsva = []
-        neighborslane = []
-        neighborsclass = []
-        neighborsdistance = []
 
-        # Get track history 'hist' = ndarray, and future track 'fut' = ndarray
-        hist = self.getHistory(vehId, t, vehId, dsId)
+        # Get track history, velocity/acceleration, lane and class of the ego and all neighbours in one pass
+        hist, va, lane, cclass, neighbors, neighborsva, neighborslane, neighborsclass, neighborsdistance = \
+            self.getWindows(vehId, t, dsId, grid)
         refdistance = np.zeros_like(hist[:, 0])
         refdistance = refdistance.reshape(len(refdistance), 1)
         fut = self.getFuture(vehId, t, dsId)
-        va = self.getVA(vehId, t, vehId, dsId)
-        lane = self.getLane(vehId, t, vehId, dsId)
-        cclass = self.getClass(vehId, t, vehId, dsId)
-
-        # Get track histories of all neighbours 'neighbors' = [ndarray,[],ndarray,ndarray]
-        for i in grid:
-            nbrsdis = self.getHistory(i.astype(int), t, vehId, dsId)
-            if nbrsdis.shape != (0, 2):
-                uu = np.power(hist - nbrsdis, 2)
-                distancexxx = np.sqrt(uu[:, 0] + uu[:, 1])
-                distancexxx = distancexxx.reshape(len(distancexxx), 1)
-            else:
-                distancexxx = np.empty([0, 1])
-            neighbors.append(nbrsdis)
-            neighborsva.append(self.getVA(i.astype(int), t, vehId, dsId))
-            neighborslane.append(self.getLane(i.astype(int), t, vehId, dsId).reshape(-1, 1))
-            neighborsclass.append(self.getClass(i.astype(int), t, vehId, dsId).reshape(-1, 1))
-            neighborsdistance.append(distancexxx)
+
         lon_enc = np.zeros([3])
         lon_enc[int(self.D[idx, 10] - 1)] = 1
         lat_enc = np.zeros([3])
         lat_enc[int(self.D[idx, 9] - 1)] = 1
         return hist, fut, neighbors, lat_enc, lon_enc, va, neighborsva, lane, neighborslane, refdistance, neighborsdistance, cclass, neighborsclass
 
+    def getRow(self, vehId, t, dsId):
+        return self.tracks.getRow(vehId, t, dsId)
+
+    ## Rows [t - t_h, t] of the track sampled every d_s frames, None if the vehicle has no full history at t
+    def getWindow(self, vehId, t, dsId):
+        if vehId == 0 or self.tracks.shape[1] <= vehId - 1:
+            return None
+        row = self.getRow(vehId, t, dsId)
+        if row < 0:
+            return None
+        window = self.tracks.track(vehId, dsId)[max(0, row - self.t_h):row + 1:self.d_s]
+        if len(window) < self.t_h // self.d_s + 1:
+            return None
+        return window
+
+    ## Fused extraction of the ego and neighbour windows used by __getitem__
+    def getWindows(self, vehId, t, dsId, grid):
+        ref = self.getWindow(vehId, t, dsId)
+        refPos = self.tracks.track(vehId, dsId)[self.getRow(vehId, t, dsId), 1:3]
+        if ref is None:
+            hist, va = np.empty([0, 2]), np.empty([0, 2])
+            lane, cclass = np.empty([0, 1]), np.empty([0, 1])
+        else:
+            hist = ref[:, 1:3] - refPos
+            va = ref[:, 3:5]
+            lane = ref[:, 5]
+            cclass = ref[:, 6]
+
+        neighbors = []
+        neighborsva = []
+        neighborslane = []
+        neighborsclass = []
+        neighborsdistance = []
+        for i in grid.astype(int).tolist():
+            window = self.getWindow(i, t, dsId) if i != 0 else None
+            if window is None:
+                # zero-size arrays can't be written to, so empty cells share them
+                neighbors.append(EMPTY2)
+                neighborsva.append(EMPTY2)
+                neighborslane.append(EMPTY1)
+                neighborsclass.append(EMPTY1)
+                neighborsdistance.append(EMPTY1)
+                continue
+            nbrsdis = window[:, 1:3] - refPos
+            uu = np.power(hist - nbrsdis, 2)
+            distancexxx = np.sqrt(uu[:, 0] + uu[:, 1])
+            neighbors.append(nbrsdis)
+            neighborsva.append(window[:, 3:5])
+            neighborslane.append(window[:, 5].reshape(-1, 1))
+            neighborsclass.append(window[:, 6].reshape(-1, 1))
+            neighborsdistance.append(distancexxx.reshape(len(distancexxx), 1))
+        return hist, va, lane, cclass, neighbors, neighborsva, neighborslane, neighborsclass, neighborsdistance
+
     def getLane(self, vehId, t, refVehId, dsId):
-        if vehId == 0:
+        window = self.getWindow(vehId, t, dsId)
+        if window is None:
             return np.empty([0, 1])
-        else:
-            if self.T.shape[1] <= vehId - 1:
-                return np.empty([0, 1])
-            refTrack = self.T[dsId - 1][refVehId - 1].transpose()
-            vehTrack = self.T[dsId - 1][vehId - 1].transpose()
-            refPos = refTrack[np.where(refTrack[:, 0] == t)][0, 5]
-
-            if vehTrack.size == 0 or np.argwhere(vehTrack[:, 0] == t).size == 0:
-                return np.empty([0, 1])
-            else:
-                stpt = np.maximum(0, np.argwhere(vehTrack[:, 0] == t).item() - self.t_h)
-                enpt = np.argwhere(vehTrack[:, 0] == t).item() + 1
-                hist = vehTrack[stpt:enpt:self.d_s, 5]
-
-            if len(hist) < self.t_h // self.d_s + 1:
-                return np.empty([0, 1])
-            return hist
+        return window[:, 5]
 
     def getClass(self, vehId, t, refVehId, dsId):
-        if vehId == 0:
+        window = self.getWindow(vehId, t, dsId)
+        if window is None:
             return np.empty([0, 1])
-        else:
-            if self.T.shape[1] <= vehId - 1:
-                return np.empty([0, 1])
-            refTrack = self.T[dsId - 1][refVehId - 1].transpose()
-            vehTrack = self.T[dsId - 1][vehId - 1].transpose()
-            refPos = refTrack[np.where(refTrack[:, 0] == t)][0, 6]
-
-            if vehTrack.size == 0 or np.argwhere(vehTrack[:, 0] == t).size == 0:
-                return np.empty([0, 1])
-            else:
-                stpt = np.maximum(0, np.argwhere(vehTrack[:, 0] == t).item() - self.t_h)
-                enpt = np.argwhere(vehTrack[:, 0] == t).item() + 1
-                hist = vehTrack[stpt:enpt:self.d_s, 6]
-
-            if len(hist) < self.t_h // self.d_s + 1:
-                return np.empty([0, 1])
-            return hist
+        return window[:, 6]
 
     def getVA(self, vehId, t, refVehId, dsId):
-        if vehId == 0:
+        window = self.getWindow(vehId, t, dsId)
+        if window is None:
             return np.empty([0, 2])
-        else:
-            if self.T.shape[1] <= vehId - 1:
-                return np.empty([0, 2])
-            refTrack = self.T[dsId - 1][refVehId - 1].transpose()
-            vehTrack = self.T[dsId - 1][vehId - 1].transpose()
-            refPos = refTrack[np.where(refTrack[:, 0] == t)][0, 3:5]
-
-            if vehTrack.size == 0 or np.argwhere(vehTrack[:, 0] == t).size == 0:
-                return np.empty([0, 2])
-            else:
-                stpt = np.maximum(0, np.argwhere(vehTrack[:, 0] == t).item() - self.t_h)
-                enpt = np.argwhere(vehTrack[:, 0] == t).item() + 1
-                hist = vehTrack[stpt:enpt:self.d_s, 3:5]
-
-            if len(hist) < self.t_h // self.d_s + 1:
-                return np.empty([0, 2])
-            return hist
+        return window[:, 3:5]
 
     ## Helper function to get track history
     def getHistory(self, vehId, t, refVehId, dsId):
-        if vehId == 0:
+        window = self.getWindow(vehId, t, dsId)
+        if window is None:
             return np.empty([0, 2])
-        else:
-            if self.T.shape[1] <= vehId - 1:
-                return np.empty([0, 2])
-            refTrack = self.T[dsId - 1][refVehId - 1].transpose()
-            vehTrack = self.T[dsId - 1][vehId - 1].transpose()
-            x = np.where(refTrack[:, 0] == t) #得到该帧在Track的索引
-            refPos = refTrack[x][0, 1:3]
-
-            if vehTrack.size == 0 or np.argwhere(vehTrack[:, 0] == t).size == 0:
-                return np.empty([0, 2])
-            else:
-                stpt = np.maximum(0, np.argwhere(vehTrack[:, 0] == t).item() - self.t_h)
-                enpt = np.argwhere(vehTrack[:, 0] == t).item() + 1
-                hist = vehTrack[stpt:enpt:self.d_s, 1:3] - refPos
-            if len(hist) < self.t_h // self.d_s + 1:
-                return np.empty([0, 2])
-            return hist
+        refPos = self.tracks.track(refVehId, dsId)[self.getRow(refVehId, t, dsId), 1:3]
+        return window[:, 1:3] - refPos
 
     def getdistance(self, vehId, t, refVehId, dsId):
-        if vehId == 0:
+        window = self.getWindow(vehId, t, dsId)
+        if window is None:
             return np.empty([0, 1])
-        else:
-            if self.T.shape[1] <= vehId - 1:
-                return np.empty([0, 1])
-            refTrack = self.T[dsId - 1][refVehId - 1].transpose()
-            vehTrack = self.T[dsId - 1][vehId - 1].transpose()
-            refPos = refTrack[np.where(refTrack[:, 0] == t)][0, 1:3]
-
-            if vehTrack.size == 0 or np.argwhere(vehTrack[:, 0] == t).size == 0:
-                return np.empty([0, 1])
-            else:
-                stpt = np.maximum(0, np.argwhere(vehTrack[:, 0] == t).item() - self.t_h)
-                enpt = np.argwhere(vehTrack[:, 0] == t).item() + 1
-                hist = vehTrack[stpt:enpt:self.d_s, 1:3] - refPos
-                hist_ref = refTrack[stpt:enpt:self.d_s, 1:3] - refPos
-                uu = np.power(hist - hist_ref, 2)
-                distance = np.sqrt(uu[:, 0] + uu[:, 1])
-                distance = distance.reshape(len(distance), 1)
-
-            if len(hist) < self.t_h // self.d_s + 1:
-                return np.empty([0, 1])
-            return distance
+        refTrack = self.tracks.track(refVehId, dsId)
+        row = self.getRow(vehId, t, dsId)
+        refPos = refTrack[self.getRow(refVehId, t, dsId), 1:3]
+        stpt = np.maximum(0, row - self.t_h)
+        hist = window[:, 1:3] - refPos
+        hist_ref = refTrack[stpt:row + 1:self.d_s, 1:3] - refPos
+        uu = np.power(hist - hist_ref, 2)
+        distance = np.sqrt(uu[:, 0] + uu[:, 1])
+        return distance.reshape(len(distance), 1)
 
     ## Helper function to get track future
     def getFuture(self, vehId, t, dsId):
-        vehTrack = self.T[dsId - 1][vehId - 1].transpose()
-        refPos = vehTrack[np.where(vehTrack[:, 0] == t)][0, 1:3]
-        stpt = np.argwhere(vehTrack[:, 0] == t).item() + self.d_s
-        enpt = np.minimum(len(vehTrack), np.argwhere(vehTrack[:, 0] == t).item() + self.t_f + 1)
+        vehTrack = self.tracks.track(vehId, dsId)
+        row = self.getRow(vehId, t, dsId)
+        refPos = vehTrack[row, 1:3]
+        stpt = row + self.d_s
+        enpt = np.minimum(len(vehTrack), row + self.t_f + 1)
         fut = vehTrack[stpt:enpt:self.d_s, 1:3] - refPos
         return fut
     #
@@ -201,8 +278,183 @@ class ngsimDataset(Dataset):
         elif 10<nbrs_num:
             return different_traffic[2]
 
+    ## (samples, 39) vehIds in the social grid of every sample, 0 for an empty cell
+    def gridIds(self):
+        return self.D[:, 11:]
+
+    ## get_different_traffic for every sample at once, as indices into TRAFFIC_LEVELS
+    def trafficLevels(self):
+        return trafficLevels(self.gridIds())
+
+    ## (dsId, vehId, frame) of the samples
+    def sampleKeys(self, indices):
+        return self.D[indices, 0:3].astype(np.int64)
+
     def collate_fn(self, samples):
-        ttt = time.time()
+        maxlen = self.t_h // self.d_s + 1
+        nbrs, nbrsva, nbrslane, nbrsdis, nbrsclass, sample_ids, cell_ids = self.gatherNeighbors(samples)
+        nbr_batch_size = len(nbrs)
+
+        # Batch tensors are allocated once at their final size and filled through numpy views
+        nbrs_batch = torch.zeros(maxlen, nbr_batch_size, 2)
+        nbrsva_batch = torch.zeros(maxlen, nbr_batch_size, 2)
+        nbrslane_batch = torch.zeros(maxlen, nbr_batch_size, 1)
+        nbrsclass_batch = torch.zeros(maxlen, nbr_batch_size, 1)
+        nbrsdis_batch = torch.zeros(maxlen, nbr_batch_size, 1)
+        stackInto(nbrs_batch.numpy(), nbrs)
+        stackInto(nbrsva_batch.numpy(), nbrsva)
+        stackInto(nbrslane_batch.numpy(), nbrslane)
+        stackInto(nbrsclass_batch.numpy(), nbrsclass)
+        stackInto(nbrsdis_batch.numpy(), nbrsdis)
+
+        # Social mask and grid coordinates (row, column) of every neighbour
+        mask_batch = torch.zeros(len(samples), self.grid_size[1], self.grid_size[0], self.enc_size, dtype=torch.bool)
+        rows = cell_ids // self.grid_size[0]
+        cols = cell_ids % self.grid_size[0]
+        mask_batch[sample_ids, rows, cols] = True
+        map_position = torch.stack((rows, cols), 1).float()
+
+        hist_batch, fut_batch, op_mask_batch, lat_enc_batch, lon_enc_batch, va_batch, lane_batch, distance_batch, \
+            class_batch = self.collateEgo(samples)
+        return hist_batch, nbrs_batch, mask_batch, lat_enc_batch, lon_enc_batch, fut_batch, op_mask_batch, va_batch, nbrsva_batch, lane_batch, nbrslane_batch, distance_batch, nbrsdis_batch, class_batch, nbrsclass_batch, map_position
+
+    ## Compact batch layout: all neighbour features packed into one (len, nbrs, 7) tensor with channels
+    ## NBR_FEATURES, the (sample, grid cell) of every neighbour and a (batch, 3, 13) occupancy map
+    ## instead of the (batch, 3, 13, enc_size) mask. unpackNeighbors() converts back to the collate_fn layout.
+    ## nbr_capacities: optional sorted neighbour counts (see NeighborBucketSampler). The neighbours are zero
+    ## padded to the smallest capacity that fits, with nbr_index rows of -1, so that batches come in a few
+    ## fixed shapes; the padded batch needs inference.forwardManeuver with nbr_cells, Net.forward would
+    ## scatter the padding rows into the social grid.
+    def collate_fn_packed(self, samples, nbr_capacities=None):
+        maxlen = self.t_h // self.d_s + 1
+        nbrs, nbrsva, nbrslane, nbrsdis, nbrsclass, sample_ids, cell_ids = self.gatherNeighbors(samples)
+        capacity = padCapacity(len(nbrs), nbr_capacities)
+        nbrs_batch = torch.zeros(maxlen, capacity, len(NBR_FEATURES))
+        packed = nbrs_batch.numpy()
+        stackInto(packed[:, :, 0:2], nbrs)
+        stackInto(packed[:, :, 2:4], nbrsva)
+        stackInto(packed[:, :, 4:5], nbrslane)
+        stackInto(packed[:, :, 5:6], nbrsdis)
+        stackInto(packed[:, :, 6:7], nbrsclass)
+        nbr_index = torch.full((capacity, 2), -1, dtype=torch.long)
+        nbr_index[:len(nbrs), 0] = sample_ids
+        nbr_index[:len(nbrs), 1] = cell_ids
+        occupancy = torch.zeros(len(samples), self.grid_size[1], self.grid_size[0], dtype=torch.bool)
+        occupancy[sample_ids, cell_ids // self.grid_size[0], cell_ids % self.grid_size[0]] = True
+
+        hist_batch, fut_batch, op_mask_batch, lat_enc_batch, lon_enc_batch, va_batch, lane_batch, distance_batch, \
+            class_batch = self.collateEgo(samples)
+        return hist_batch, nbrs_batch, nbr_index, occupancy, lat_enc_batch, lon_enc_batch, fut_batch, op_mask_batch, va_batch, lane_batch, distance_batch, class_batch
+
+    ## Batch of the samples at the given indices in which every (dsId, vehId, frame) window is extracted and
+    ## stored once, however many egos have it as neighbour (or are that vehicle): absolute float64 positions
+    ## (len, unique, 2) and [v, a, lane, class] features (len, unique, 4) of the unique windows, the window
+    ## of every ego (-1 without full history), ego reference positions, (ego, grid cell) of every neighbour
+    ## and its window, maneuvers, future, output mask and the sample indices. expandScene() rebuilds the
+    ## collate_fn_packed tensors. Meant for batches of SceneBatchSampler, where egos share their neighbours.
+    def collate_fn_scene(self, indices):
+        maxlen = self.t_h // self.d_s + 1
+        batch_size = len(indices)
+        unique = {}
+        windows = []
+
+        def windowIndex(vehId, t, dsId):
+            key = (dsId, vehId, t)
+            u = unique.get(key)
+            if u is None:
+                window = self.getWindow(vehId, t, dsId)
+                u = unique[key] = len(windows) if window is not None else -1
+                if window is not None:
+                    windows.append(window)
+            return u
+
+        ego_index, refs, futs, sample_ids, cell_ids, nbr_unique = [], [], [], [], [], []
+        lat_enc_batch = torch.zeros(batch_size, 3)
+        lon_enc_batch = torch.zeros(batch_size, 3)
+        for b, idx in enumerate(indices):
+            dsId = int(self.D[idx, 0])
+            vehId = int(self.D[idx, 1])
+            t = self.D[idx, 2]
+            refs.append(self.tracks.track(vehId, dsId)[self.getRow(vehId, t, dsId), 1:3])
+            ego_index.append(windowIndex(vehId, t, dsId))
+            futs.append(self.getFuture(vehId, t, dsId))
+            lat_enc_batch[b, int(self.D[idx, 9] - 1)] = 1
+            lon_enc_batch[b, int(self.D[idx, 10] - 1)] = 1
+            for cell, i in enumerate(self.D[idx, 11:].astype(int).tolist()):
+                u = windowIndex(i, t, dsId) if i != 0 else -1
+                if u >= 0:
+                    sample_ids.append(b)
+                    cell_ids.append(cell)
+                    nbr_unique.append(u)
+
+        positions = torch.zeros(maxlen, len(windows), 2, dtype=torch.float64)
+        features = torch.zeros(maxlen, len(windows), 4)
+        stackInto(positions.numpy(), [w[:, 1:3] for w in windows])
+        stackInto(features.numpy(), [w[:, 3:7] for w in windows])
+        fut_batch = torch.zeros(self.t_f // self.d_s, batch_size, 2)
+        stackInto(fut_batch.numpy(), futs)
+        fut_len = torch.tensor([len(fut) for fut in futs], dtype=torch.long)
+        op_mask_batch = (torch.arange(self.t_f // self.d_s).unsqueeze(1) < fut_len).float()
+        op_mask_batch = op_mask_batch.unsqueeze(2).repeat(1, 1, 2)
+        nbr_index = torch.stack((torch.tensor(sample_ids, dtype=torch.long), torch.tensor(cell_ids, dtype=torch.long)), 1)
+        return positions, features, torch.tensor(ego_index, dtype=torch.long), torch.from_numpy(np.array(refs)).view(-1, 2), \
+            nbr_index, torch.tensor(nbr_unique, dtype=torch.long), lat_enc_batch, lon_enc_batch, fut_batch, op_mask_batch, \
+            torch.as_tensor(indices, dtype=torch.long)
+
+    ## Non-empty neighbours of the whole batch gathered in a single pass, with their sample and grid cell ids
+    def gatherNeighbors(self, samples):
+        nbrs, nbrsva, nbrslane, nbrsdis, nbrsclass, sample_ids, cell_ids = [], [], [], [], [], [], []
+        for sampleId, sample in enumerate(samples):
+            for cell, nbr in enumerate(sample[2]):
+                if len(nbr) != 0:
+                    nbrs.append(nbr)
+                    nbrsva.append(sample[6][cell])
+                    nbrslane.append(sample[8][cell])
+                    nbrsdis.append(sample[10][cell])
+                    nbrsclass.append(sample[12][cell])
+                    sample_ids.append(sampleId)
+                    cell_ids.append(cell)
+        sample_ids = torch.tensor(sample_ids, dtype=torch.long)
+        cell_ids = torch.tensor(cell_ids, dtype=torch.long)
+        return nbrs, nbrsva, nbrslane, nbrsdis, nbrsclass, sample_ids, cell_ids
+
+    ## History, future, output mask, maneuver, va, lane, distance and class batches of the egos
+    def collateEgo(self, samples):
+        maxlen = self.t_h // self.d_s + 1
+        batch_size = len(samples)
+        hists, futs, lat_encs, lon_encs, vas, lanes, refdistances, cclasses = [], [], [], [], [], [], [], []
+        for hist, fut, _, lat_enc, lon_enc, va, _, lane, _, refdistance, _, cclass, _ in samples:
+            hists.append(hist)
+            futs.append(fut)
+            lat_encs.append(lat_enc)
+            lon_encs.append(lon_enc)
+            vas.append(va)
+            lanes.append(lane)
+            refdistances.append(refdistance)
+            cclasses.append(cclass)
+        hist_batch = torch.zeros(maxlen, batch_size, 2)  # (len1,batch,2)
+        distance_batch = torch.zeros(maxlen, batch_size, 1)
+        fut_batch = torch.zeros(self.t_f // self.d_s, batch_size, 2)  # (len2,batch,2)
+        lat_enc_batch = torch.zeros(batch_size, 3)  # (batch,3)
+        lon_enc_batch = torch.zeros(batch_size, 3)  # (batch,3)
+        va_batch = torch.zeros(maxlen, batch_size, 2)
+        lane_batch = torch.zeros(maxlen, batch_size, 1)
+        class_batch = torch.zeros(maxlen, batch_size, 1)
+        stackInto(hist_batch.numpy(), hists)
+        stackInto(distance_batch.numpy(), refdistances)
+        stackInto(fut_batch.numpy(), futs)
+        stackInto(lat_enc_batch.numpy().T, lat_encs)
+        stackInto(lon_enc_batch.numpy().T, lon_encs)
+        stackInto(va_batch.numpy(), vas)
+        stackInto(lane_batch.numpy()[:, :, 0], lanes)
+        stackInto(class_batch.numpy()[:, :, 0], cclasses)
+        fut_len = torch.tensor([len(fut) for fut in futs], dtype=torch.long)
+        op_mask_batch = (torch.arange(self.t_f // self.d_s).unsqueeze(1) < fut_len).float()
+        op_mask_batch = op_mask_batch.unsqueeze(2).repeat(1, 1, 2)  # (len2,batch,2)
+        return hist_batch, fut_batch, op_mask_batch, lat_enc_batch, lon_enc_batch, va_batch, lane_batch, distance_batch, class_batch
+
+    ## Reference per-sample implementation of collate_fn, kept for benchmark.py
+    def collate_fn_loop(self, samples):
         # Initialize neighbors and neighbors length batches:
         nbr_batch_size = 0
         for _, _, nbrs, _, _, _, _, _, _, _, _, _, _ in samples:
@@ -293,3 +545,93 @@ class ngsimDataset(Dataset):
         #if (self.count > args['time']):
         #    print(self.alltime / self.count, "data load time")
         return hist_batch, nbrs_batch, mask_batch, lat_enc_batch, lon_enc_batch, fut_batch, op_mask_batch, va_batch, nbrsva_batch, lane_batch, nbrslane_batch, distance_batch, nbrsdis_batch, class_batch, nbrsclass_batch, map_position
+
+
+## Batch sampler that keeps the samples of a (dsId, frame) scene together: the vehicles of a scene are each
+## other's neighbours, so collate_fn_scene extracts their windows once for the whole batch. Scenes are
+## packed whole into batches of at most batch_size samples (larger scenes are split).
+class SceneBatchSampler(Sampler):
+
+    def __init__(self, dataset, batch_size, shuffle=False, seed=0):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        keys = dataset.D[:, [0, 2]]
+        order = np.lexsort((keys[:, 1], keys[:, 0]), axis=0)
+        bounds = np.flatnonzero(np.any(np.diff(keys[order], axis=0) != 0, axis=1)) + 1
+        self.scenes = np.split(order, bounds)
+        self.num_batches = sum(1 for _ in self.batches(self.scenes))
+
+    def batches(self, scenes):
+        batch = []
+        for scene in scenes:
+            if len(batch) + len(scene) > self.batch_size and batch:
+                yield batch
+                batch = []
+            for i in scene.tolist():
+                batch.append(i)
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def __iter__(self):
+        scenes = self.scenes
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + self.epoch).permutation(len(scenes))
+            scenes = [scenes[i] for i in order]
+            self.epoch += 1
+        return self.batches(scenes)
+
+    def __len__(self):
+        return self.num_batches
+
+
+## Dataset of collate_fn_scene batches for DataLoader(..., batch_size=None), so that the workers build
+## whole scene batches instead of going through __getitem__ for every sample
+class SceneBatches(Dataset):
+
+    def __init__(self, dataset, batch_sampler):
+        self.dataset = dataset
+        self.batches = list(batch_sampler)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, idx):
+        return self.dataset.collate_fn_scene(self.batches[idx])
+
+
+## Batch sampler that buckets the samples by neighbour count (occupied grid cells, an upper bound of the
+## neighbours with a full history) so that the neighbour tensors of a batch can be padded to one of a few
+## fixed capacities: pass capacities to collate_fn_packed through nbr_capacities. Bucket edges
+## are count quantiles; every sample is in exactly one batch.
+class NeighborBucketSampler(Sampler):
+
+    def __init__(self, dataset, batch_size, num_buckets=4, shuffle=False, seed=0):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        counts = np.count_nonzero(dataset.gridIds(), axis=1)
+        self.edges = np.unique(np.ceil(np.quantile(counts, np.arange(1, num_buckets + 1) / num_buckets)).astype(int))
+        bucket = np.searchsorted(self.edges, counts)
+        self.buckets = [np.flatnonzero(bucket == b) for b in range(len(self.edges))]
+        self.capacities = [batch_size * int(edge) for edge in self.edges]
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = []
+        for samples in self.buckets:
+            if self.shuffle:
+                samples = rng.permutation(samples)
+            batches.extend(samples[i:i + self.batch_size].tolist() for i in range(0, len(samples), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+            self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return sum((len(samples) + self.batch_size - 1) // self.batch_size for samples in self.buckets)
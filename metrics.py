@@ -0,0 +1,155 @@
+from __future__ import print_function, division
+import argparse
+import torch as t
+from loader import TRAFFIC_LEVELS
+
+FEET_TO_METERS = 0.3048
+STRATA = ('traffic', 'lat', 'lon')
+SUMS = ('sq_err', 'disp', 'count', 'nll', 'nll_count', 'fde', 'fde_count')  # StratifiedMetrics accumulators
+
+
+## Per-step NLL (len, batch) of a bivariate Gaussian prediction (len, batch, 5), as in Evaluate.maskedNLLTest
+def bivariateNLL(y_pred, y_gt):
+    muX = y_pred[:, :, 0]
+    muY = y_pred[:, :, 1]
+    sigX = y_pred[:, :, 2]
+    sigY = y_pred[:, :, 3]
+    rho = y_pred[:, :, 4]
+    ohr = t.pow(1 - t.pow(rho, 2), -0.5)
+    x = y_gt[:, :, 0]
+    y = y_gt[:, :, 1]
+    return 0.5 * t.pow(ohr, 2) * (t.pow(sigX, 2) * t.pow(x - muX, 2) + t.pow(sigY, 2) * t.pow(y - muY, 2)
+                                  - 2 * rho * sigX * sigY * (x - muX) * (y - muY)) - t.log(sigX * sigY * ohr) + 1.8379
+
+
+## Per-step NLL (len, batch) of the maneuver mixture: fut_pred is the list (or (9, len, batch, 5) stack) of
+## maneuver-conditioned predictions ordered lon * 3 + lat, weighted by lat_pred * lon_pred. All modes are
+## evaluated in one expression with the same likelihood terms as Evaluate.maskedNLLTest.
+def multiModalNLL(fut_pred, lat_pred, lon_pred, fut):
+    if isinstance(fut_pred, (list, tuple)):
+        fut_pred = t.stack(fut_pred)
+    muX = fut_pred[..., 0]
+    muY = fut_pred[..., 1]
+    sigX = fut_pred[..., 2]
+    sigY = fut_pred[..., 3]
+    rho = fut_pred[..., 4]
+    ohr = t.pow(1 - t.pow(rho, 2), -0.5)
+    dx = fut[:, :, 0] - muX
+    dy = fut[:, :, 1] - muY
+    out = -(0.5 * t.pow(ohr, 2) * (t.pow(sigX, 2) * t.pow(dx, 2) + 0.5 * t.pow(sigY, 2) * t.pow(dy, 2)
+                                   - rho * sigX * sigY * dx * dy) - t.log(sigX * sigY * ohr) + 1.8379)
+    wts = (lon_pred.unsqueeze(2) * lat_pred.unsqueeze(1)).reshape(lat_pred.shape[0], -1)  # (batch, lon * lat)
+    return -t.logsumexp(out + t.log(wts).t().unsqueeze(1), dim=0)
+
+
+## Picks the ground-truth maneuver's prediction (len, batch, 5) for every sample out of the list (or
+## (9, len, batch, 5) stack) of maneuver-conditioned predictions with a single gather
+def selectManeuver(fut_pred, lat_enc, lon_enc):
+    if isinstance(fut_pred, (list, tuple)):
+        fut_pred = t.stack(fut_pred)
+    index = t.argmax(lon_enc, dim=1) * lat_enc.shape[1] + t.argmax(lat_enc, dim=1)
+    index = index.view(1, 1, -1, 1).expand(1, fut_pred.shape[1], -1, fut_pred.shape[3])
+    return fut_pred.gather(0, index).squeeze(0)
+
+
+## Streaming RMSE / ADE / FDE / NLL accumulator stratified by traffic level x lateral maneuver x longitudinal
+## maneuver x horizon step. Sums stay on the device (no per-batch host syncs) and partial results from
+## several shards can be merged before computing the final numbers.
+class StratifiedMetrics(object):
+
+    def __init__(self, out_length=25, device='cpu', num_levels=len(TRAFFIC_LEVELS), num_lat_classes=3,
+                 num_lon_classes=3):
+        self.shape = (num_levels, num_lat_classes, num_lon_classes)
+        strata = num_levels * num_lat_classes * num_lon_classes
+        self.sq_err = t.zeros(strata, out_length, device=device)  # squared displacement
+        self.disp = t.zeros(strata, out_length, device=device)  # displacement
+        self.count = t.zeros(strata, out_length, device=device)
+        self.nll = t.zeros(strata, out_length, device=device)
+        self.nll_count = t.zeros(strata, out_length, device=device)
+        self.fde = t.zeros(strata, device=device)  # displacement at the last observed future step
+        self.fde_count = t.zeros(strata, device=device)
+
+    ## fut_pred: (len, batch, >=2) point prediction, fut / op_mask: (len, batch, 2), lat_enc / lon_enc: one-hot
+    ## (batch, 3) maneuvers, level: (batch,) traffic level, nll: optional (len, batch) per-step NLL
+    def update(self, fut_pred, fut, op_mask, lat_enc, lon_enc, level, nll=None):
+        mask = op_mask[:, :, 0]
+        stratum = (level * self.shape[1] + t.argmax(lat_enc, dim=1)) * self.shape[2] + t.argmax(lon_enc, dim=1)
+        sq_err = (t.pow(fut_pred[:, :, 0] - fut[:, :, 0], 2) + t.pow(fut_pred[:, :, 1] - fut[:, :, 1], 2)) * mask
+        disp = t.sqrt(sq_err)
+        self.sq_err.index_add_(0, stratum, sq_err.t())
+        self.disp.index_add_(0, stratum, disp.t())
+        self.count.index_add_(0, stratum, mask.t())
+        last = mask.sum(0).long() - 1  # the output mask is a prefix of the horizon
+        observed = (last >= 0).to(disp.dtype)
+        self.fde.index_add_(0, stratum, disp.gather(0, last.clamp(min=0).unsqueeze(0)).squeeze(0) * observed)
+        self.fde_count.index_add_(0, stratum, observed)
+        if nll is not None:
+            self.nll.index_add_(0, stratum, (nll * mask).t())
+            self.nll_count.index_add_(0, stratum, mask.t())
+
+    def state_dict(self):
+        return {'shape': self.shape, 'sq_err': self.sq_err.cpu(), 'disp': self.disp.cpu(), 'count': self.count.cpu(),
+                'nll': self.nll.cpu(), 'nll_count': self.nll_count.cpu(), 'fde': self.fde.cpu(),
+                'fde_count': self.fde_count.cpu()}
+
+    @classmethod
+    def fromStateDict(cls, state, device='cpu'):
+        metrics = cls(state['sq_err'].shape[1], device, *state['shape'])
+        metrics.merge(state)
+        return metrics
+
+    ## Adds another accumulator (or its state_dict) of the same shape, e.g. from another shard
+    def merge(self, other):
+        if isinstance(other, StratifiedMetrics):
+            other = other.state_dict()
+        for name in SUMS:
+            getattr(self, name).add_(other[name].to(getattr(self, name).device))
+        return self
+
+    ## Metrics in meters over the strata selected by the boolean (traffic, lat, lon) masks, None = all
+    def summary(self, traffic=None, lat=None, lon=None):
+        select = t.ones(self.shape, dtype=t.bool)
+        if traffic is not None:
+            select &= t.as_tensor(traffic).view(-1, 1, 1)
+        if lat is not None:
+            select &= t.as_tensor(lat).view(1, -1, 1)
+        if lon is not None:
+            select &= t.as_tensor(lon).view(1, 1, -1)
+        select = select.flatten().to(self.count.device)
+        count = self.count[select].sum(0)
+        nll_count = self.nll_count[select].sum(0)
+        rmse = t.sqrt(self.sq_err[select].sum(0) / count) * FEET_TO_METERS
+        return {'samples': self.fde_count[select].sum().item(),
+                'rmse': rmse.cpu(),  # per horizon step
+                'ade': (self.disp[select].sum(0).cumsum(0) / count.cumsum(0) * FEET_TO_METERS).cpu(),  # up to each step
+                'fde': (self.fde[select].sum() / self.fde_count[select].sum() * FEET_TO_METERS).item(),
+                'nll': (self.nll[select].sum(0) / nll_count).cpu() if nll_count.sum() > 0 else None}
+
+    ## Table of the overall metrics and the breakdown by traffic level, lateral and longitudinal maneuver
+    def report(self, step=5):
+        rows = [('overall', self.summary())]
+        for i, name in enumerate(TRAFFIC_LEVELS[:self.shape[0]]):
+            rows.append(('traffic=' + name, self.summary(traffic=[j == i for j in range(self.shape[0])])))
+        for i in range(self.shape[1]):
+            rows.append(('lat={}'.format(i + 1), self.summary(lat=[j == i for j in range(self.shape[1])])))
+        for i in range(self.shape[2]):
+            rows.append(('lon={}'.format(i + 1), self.summary(lon=[j == i for j in range(self.shape[2])])))
+        horizons = range(step - 1, self.count.shape[1], step)
+        header = '{:<18}{:>9}'.format('stratum', 'samples') + ''.join(
+            '{:>9}'.format('RMSE@{}'.format(h + 1)) for h in horizons) + '{:>9}{:>9}{:>9}'.format('ADE', 'FDE', 'NLL')
+        print(header)
+        for name, s in rows:
+            nll = s['nll'].mean().item() if s['nll'] is not None else float('nan')
+            print('{:<18}{:>9d}'.format(name, int(s['samples'])) + ''.join('{:>9.3f}'.format(s['rmse'][h]) for h in horizons)
+                  + '{:>9.3f}{:>9.3f}{:>9.3f}'.format(s['ade'][-1], s['fde'], nll))
+
+
+## Merges the accumulators saved by `evaluate.py --metrics_out` on several shards and prints the report
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merging metrics:')
+    parser.add_argument('files', nargs='+', help='StratifiedMetrics state dicts saved with torch.save')
+    args = parser.parse_args()
+    metrics = StratifiedMetrics.fromStateDict(t.load(args.files[0]))
+    for path in args.files[1:]:
+        metrics.merge(t.load(path))
+    metrics.report()
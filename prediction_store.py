@@ -0,0 +1,89 @@
+from __future__ import print_function, division
+import glob
+import json
+import os
+import numpy as np
+import torch
+
+STORE_VERSION = 1
+PREDICTION_ARRAYS = ('keys', 'fut_pred', 'lat_pred', 'lon_pred')
+
+
+def chunkPath(out_dir, index):
+    return os.path.join(out_dir, 'chunk_{:05d}.npz'.format(index))
+
+
+## np.save / torch.save to a temporary file renamed over path, so a file is either complete or absent
+def writeAtomic(path, save, obj):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        save(f, obj)
+    os.replace(tmp_path, path)
+
+
+## Chunked on-disk store of the per-sample predictions of an evaluation, which can be resumed after an
+## interruption. out_dir holds chunk_00000.npz, ... with
+##   keys (n, 3) [dsId, vehId, frame], fut_pred (n, modes, out_length, 5) for the decoded maneuvers (9 in
+##   Net order, or the one selected by --decode_maneuver), lat_pred / lon_pred (n, 3),
+## meta.json, the run configuration (a resumed run must match it), and state.pt, the evaluation state (batches
+## done, accumulated sums) saved together with every chunk. Predictions are buffered in memory up to chunk_size
+## samples; an interrupted run loses at most the batches after the last chunk and repeats them on resume.
+class PredictionWriter(object):
+
+    def __init__(self, out_dir, meta, chunk_size=16384):
+        self.out_dir = out_dir
+        self.chunk_size = chunk_size
+        self.buffer = dict((name, []) for name in PREDICTION_ARRAYS)
+        self.buffered = 0
+        self.chunks = 0
+        self.state = None
+        meta = dict(meta, version=STORE_VERSION)
+        meta_path = os.path.join(out_dir, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                saved = json.load(f)
+            if saved != json.loads(json.dumps(meta)):
+                raise ValueError('{} holds predictions of a different run configuration'.format(out_dir))
+            state_path = os.path.join(out_dir, 'state.pt')
+            if os.path.exists(state_path):
+                self.state = torch.load(state_path, map_location='cpu', weights_only=True)
+                self.chunks = self.state['chunks']
+        else:
+            os.makedirs(out_dir, exist_ok=True)
+            writeAtomic(meta_path, lambda f, obj: f.write(json.dumps(obj, indent=1).encode()), meta)
+        for path in glob.glob(os.path.join(out_dir, 'chunk_*.npz')):  # written after the last saved state
+            if int(os.path.basename(path)[6:11]) >= self.chunks:
+                os.remove(path)
+
+    ## Predictions of one batch: keys (batch, 3), fut_pred (out_length, batch, 5) or a list of them per maneuver
+    def append(self, keys, fut_pred, lat_pred, lon_pred):
+        if isinstance(fut_pred, (list, tuple)):
+            fut_pred = torch.stack(fut_pred)
+        else:
+            fut_pred = fut_pred.unsqueeze(0)
+        self.buffer['keys'].append(np.asarray(keys, dtype=np.int64))
+        self.buffer['fut_pred'].append(fut_pred.permute(2, 0, 1, 3).float().cpu().numpy())
+        self.buffer['lat_pred'].append(lat_pred.float().cpu().numpy())
+        self.buffer['lon_pred'].append(lon_pred.float().cpu().numpy())
+        self.buffered += len(keys)
+
+    def isFull(self):
+        return self.buffered >= self.chunk_size
+
+    ## Writes the buffered predictions as the next chunk, then state (a dict of tensors and numbers describing
+    ## the evaluation up to the last appended batch)
+    def flush(self, state):
+        if self.buffered:
+            arrays = dict((name, np.concatenate(self.buffer[name])) for name in PREDICTION_ARRAYS)
+            writeAtomic(chunkPath(self.out_dir, self.chunks), lambda f, obj: np.savez(f, **obj), arrays)
+            self.chunks += 1
+            self.buffer = dict((name, []) for name in PREDICTION_ARRAYS)
+            self.buffered = 0
+        self.state = dict(state, chunks=self.chunks)
+        writeAtomic(os.path.join(self.out_dir, 'state.pt'), lambda f, obj: torch.save(obj, f), self.state)
+
+
+## All chunks of a prediction store, concatenated: {name: array}
+def readPredictions(out_dir):
+    chunks = [np.load(path) for path in sorted(glob.glob(os.path.join(out_dir, 'chunk_*.npz')))]
+    return dict((name, np.concatenate([chunk[name] for chunk in chunks])) for name in PREDICTION_ARRAYS)
@@ -0,0 +1,126 @@
+from __future__ import print_function, division
+import collections
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+END = object()  # end of the loader, queued after the last batch
+
+
+## Tensors of a (nested tuple / list) batch moved to device
+def toDevice(data, device, non_blocking=False):
+    if isinstance(data, torch.Tensor):
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, (list, tuple)):
+        return type(data)(toDevice(d, device, non_blocking) for d in data)
+    return data
+
+
+def flatTensors(data):
+    if isinstance(data, torch.Tensor):
+        yield data
+    elif isinstance(data, (list, tuple)):
+        for d in data:
+            for x in flatTensors(d):
+                yield x
+
+
+## Iterates loader on a background thread that stages up to depth batches ahead of the consumer: stage(data)
+## converts a loader batch into device tensors while the current batch runs. On CUDA the staging runs on a side
+## stream, so the (pinned, non_blocking) copies overlap the forward pass; the consumer's stream waits for them
+## before the batch is handed out. Batches come out in loader order, and an exception raised by the loader or
+## stage is re-raised in the consumer.
+class Prefetcher(object):
+
+    def __init__(self, loader, stage, device, depth=2):
+        self.loader = loader
+        self.stage = stage
+        self.device = device
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        ready = queue.Queue(self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():  # the consumer may stop early, don't block on a full queue forever
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                with torch.no_grad():  # grad mode is per thread
+                    for data in self.loader:
+                        event = None
+                        if stream is not None:
+                            with torch.cuda.stream(stream):
+                                data = self.stage(data)
+                                event = torch.cuda.Event()
+                                event.record(stream)
+                        else:
+                            data = self.stage(data)
+                        if not put((data, event)):
+                            return
+                put(END)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                data, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    for x in flatTensors(data):
+                        if x.is_cuda:
+                            x.record_stream(current)  # allocated on the side stream, used and freed on this one
+                yield data
+        finally:
+            stop.set()
+            thread.join()
+
+
+## Runs fn(*args) calls one after the other on a background thread, so e.g. the metric reduction of a batch
+## (and its host synchronizations) overlaps the next forward pass. At most depth calls are pending; submit()
+## waits for the oldest beyond that. drain() waits for all of them and re-raises the first exception.
+class SerialWorker(object):
+
+    def __init__(self, depth=2):
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = collections.deque()
+
+    def run(self, fn, args):
+        with torch.no_grad():
+            return fn(*args)
+
+    def submit(self, fn, *args):
+        while len(self.pending) >= self.depth:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(self.run, fn, args))
+
+    def drain(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        try:
+            self.drain()
+        finally:
+            self.executor.shutdown()
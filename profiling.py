@@ -0,0 +1,135 @@
+from __future__ import print_function, division
+import copy
+import os
+import time
+import torch
+
+## Net submodules timed by ModuleProfiler (by class name; classes the model doesn't have are skipped)
+PROFILED_MODULES = ('SparseSpatialTransformer', 'SparseSpatialAttention', 'LocalGlobalTemporalTransformer',
+                    'SparseTemporalAttention', 'PositionalEncoding', 'LSTM')
+
+
+## Flattens thop's per-layer tree into {qualified module name: MACs}
+def flattenOps(layers, prefix=''):
+    ops = {}
+    for name, (macs, _, children) in layers.items():
+        ops[prefix + name] = macs
+        ops.update(flattenOps(children, prefix + name + '.'))
+    return ops
+
+
+## Opt-in instrumentation of the Net hot path: forward hooks on the PROFILED_MODULES instances and a wrapper
+## around Net.decode record the wall time per call (synchronizing the device around each module), the peak
+## CUDA memory while the module runs, and a torch.profiler range named after the module; start() and stop()
+## bracket a torch.profiler run whose Chrome trace is written to out_dir. Nothing is attached before start(),
+## so an unprofiled run is unaffected.
+class ModuleProfiler(object):
+
+    def __init__(self, net, out_dir='profile', module_types=PROFILED_MODULES):
+        self.net = net
+        self.out_dir = out_dir
+        self.modules = [(name, m) for name, m in net.named_modules() if type(m).__name__ in module_types]
+        self.time = {}
+        self.calls = {}
+        self.peak = {}
+        self.stack = []
+        self.handles = []
+        self.inputs = None
+        self.profiler = None
+        self.decode = None
+
+    def synchronize(self):
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+    def enter(self, name):
+        self.synchronize()
+        scope = torch.profiler.record_function(name)
+        scope.__enter__()
+        memory = [0, 0]  # allocated at entry, highest peak seen inside
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            memory = [torch.cuda.memory_allocated()] * 2
+            torch.cuda.reset_peak_memory_stats()
+        self.stack.append((name, scope, memory, time.perf_counter()))
+
+    def exit(self):
+        self.synchronize()
+        name, scope, memory, start = self.stack.pop()
+        self.time[name] = self.time.get(name, 0.0) + time.perf_counter() - start
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            # nested modules reset the peak counter, so their peaks are passed up to the enclosing module
+            peak = max(memory[1], torch.cuda.max_memory_allocated())
+            self.peak[name] = max(self.peak.get(name, 0), peak - memory[0])
+            if self.stack:
+                self.stack[-1][2][1] = max(self.stack[-1][2][1], peak)
+        scope.__exit__(None, None, None)
+
+    def wrapDecode(self, decode):
+        def forward(*args, **kwargs):
+            self.enter('decode')
+            out = decode(*args, **kwargs)
+            self.exit()
+            return out
+        return forward
+
+    def start(self):
+        for name, module in self.modules:
+            self.handles.append(module.register_forward_pre_hook(lambda m, args, name=name: self.enter(name)))
+            self.handles.append(module.register_forward_hook(lambda m, args, out: self.exit()))
+        self.decode = self.net.__dict__.get('decode')  # set if prepareNet wrapped it
+        self.net.decode = self.wrapDecode(self.net.decode)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, profile_memory=True)
+        self.profiler.__enter__()
+        return self
+
+    ## Net inputs of one batch, for the thop MAC count in stop()
+    def record(self, *inputs):
+        if self.inputs is None:
+            self.inputs = inputs
+
+    ## forward_time: total time of the profiled forward passes, for the share of each module
+    def stop(self, forward_time):
+        self.profiler.__exit__(None, None, None)
+        for handle in self.handles:
+            handle.remove()
+        if self.decode is None:
+            del self.net.decode  # back to Net.decode
+        else:
+            self.net.decode = self.decode
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.profiler.export_chrome_trace(os.path.join(self.out_dir, 'trace.json'))
+        macs = {}
+        if self.inputs is not None:
+            import thop
+            _, _, layers = thop.profile(copy.deepcopy(self.net), inputs=self.inputs, verbose=False,
+                                        ret_layer_info=True)
+            macs = flattenOps(layers)
+        self.report(forward_time, macs)
+
+    ## Time (total, per call and share of the forward time), MACs per batch and peak CUDA memory per module.
+    ## Times are inclusive: a transformer block contains its attention module. thop counts nn layers
+    ## (Linear, LSTM, Conv, norms) on one batch, not the functional matmuls inside the attention. Peak memory is
+    ## only tracked on CUDA; on CPU the column is left out.
+    def report(self, forward_time, macs):
+        memory = bool(self.peak)
+        header = '{:<48}{:>8}{:>12}{:>12}{:>8}{:>14}'.format('module', 'calls', 'total (ms)', 'call (ms)', 'share',
+                                                              'MMACs/batch')
+        lines = [header + ('{:>11}'.format('peak (MB)') if memory else '')]
+        for name in sorted(self.time):
+            line = '{:<48}{:>8}{:>12.1f}{:>12.3f}{:>8.1%}{:>14}'.format(
+                name, self.calls[name], self.time[name] * 1000, self.time[name] * 1000 / self.calls[name],
+                self.time[name] / forward_time if forward_time else 0.0,
+                '{:.2f}'.format(macs[name] / 1e6) if name in macs else '-')
+            if memory:
+                line += '{:>11}'.format('{:.1f}'.format(self.peak[name] / 2 ** 20) if name in self.peak else '-')
+            lines.append(line)
+        lines.append('{:<48}{:>8}{:>12.1f}'.format('forward', '', forward_time * 1000))
+        table = '\n'.join(lines)
+        print(table)
+        with open(os.path.join(self.out_dir, 'modules.txt'), 'w') as f:
+            f.write(table + '\n')
+        print('Chrome trace: {}'.format(os.path.join(self.out_dir, 'trace.json')))
@@ -0,0 +1,84 @@
+from __future__ import print_function, division
+import argparse
+import io
+import time
+import numpy as np
+import torch as t
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from loader import ngsimDataset
+from checkpoint import loadModel
+from metrics import selectManeuver, FEET_TO_METERS
+
+parser = argparse.ArgumentParser(description='Quantizing:')
+parser.add_argument('--model', type=str, default='trained_models/SSTT_ngsim.pth', help='fp32 model to quantize')
+parser.add_argument('--out', type=str, default='trained_models/SSTT_ngsim_int8.pth', help='quantized model path')
+parser.add_argument('--test_set', type=str, default='data/ngsim/TestSet.mat', help='dataset for the report')
+parser.add_argument('--batch_size', type=int, default=256)
+parser.add_argument('--batches', type=int, default=50, help='batches compared in the report (0: whole test set)')
+parser.add_argument('--num_threads', type=int, default=None, help='CPU threads used for the latency measurement')
+
+
+## INT8 dynamic quantization of the LSTM and Linear layers (including the FeedForward blocks and the
+## attention projections): weights are stored as int8, activations are quantized on the fly, so the model
+## runs on CPU without calibration data. The convolution gates and the mapping parameter stay fp32.
+def quantizeNet(net):
+    net = net.cpu().eval()
+    return t.ao.quantization.quantize_dynamic(net, {nn.LSTM, nn.Linear}, dtype=t.qint8)
+
+
+def modelSize(net):
+    buffer = io.BytesIO()
+    t.save(net, buffer)
+    return buffer.tell()
+
+
+## Per-batch latency and RMSE per horizon step (meters) of the ground-truth maneuver's prediction
+def evaluateNet(net, dataloader, batches):
+    times = []
+    sq_err = t.zeros(net.out_length)
+    counts = t.zeros(net.out_length)
+    with t.no_grad():
+        for idx, data in enumerate(dataloader):
+            if batches and idx == batches:
+                break
+            hist, nbrs, mask, lat_enc, lon_enc, fut, op_mask, va, nbrsva, _, _, _, _, cls, nbrscls, _ = data
+            te = time.perf_counter()
+            fut_pred, _, _ = net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+            times.append(time.perf_counter() - te)
+            fut_pred = selectManeuver(fut_pred, lat_enc, lon_enc)
+            fut = fut[:net.out_length]
+            mask = op_mask[:net.out_length, :, 0]
+            sq_err += ((t.pow(fut_pred[:, :, 0] - fut[:, :, 0], 2) + t.pow(fut_pred[:, :, 1] - fut[:, :, 1], 2)) * mask).sum(1)
+            counts += mask.sum(1)
+    return np.array(times), t.sqrt(sq_err / counts) * FEET_TO_METERS
+
+
+def report(fp32, int8, dataloader, batches):
+    fp32_times, fp32_rmse = evaluateNet(fp32, dataloader, batches)
+    int8_times, int8_rmse = evaluateNet(int8, dataloader, batches)
+    fp32_size, int8_size = modelSize(fp32), modelSize(int8)
+    print('{:<24}{:>12}{:>12}{:>12}'.format('', 'fp32', 'int8', 'ratio'))
+    print('{:<24}{:>12.2f}{:>12.2f}{:>12.2f}'.format('model size (MB)', fp32_size / 2 ** 20, int8_size / 2 ** 20,
+                                                     int8_size / fp32_size))
+    for name, q in (('latency p50 (ms)', 50), ('latency p95 (ms)', 95)):
+        a, b = np.percentile(fp32_times, q) * 1000, np.percentile(int8_times, q) * 1000
+        print('{:<24}{:>12.2f}{:>12.2f}{:>12.2f}'.format(name, a, b, b / a))
+    for step in range(4, len(fp32_rmse), 5):
+        print('{:<24}{:>12.3f}{:>12.3f}{:>+12.3f}'.format('RMSE@{}s (m)'.format((step + 1) // 5), fp32_rmse[step],
+                                                          int8_rmse[step], int8_rmse[step] - fp32_rmse[step]))
+    print('{:<24}{:>12.3f}{:>12.3f}{:>+12.3f}'.format('FDE mean (m)', fp32_rmse[4::5].mean(), int8_rmse[4::5].mean(),
+                                                      (int8_rmse[4::5] - fp32_rmse[4::5]).mean()))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.num_threads:
+        t.set_num_threads(args.num_threads)
+    fp32 = loadModel(args.model)
+    int8 = quantizeNet(loadModel(args.model))
+    t.save(int8, args.out)
+    print('saved', args.out)
+    dataset = ngsimDataset(args.test_set)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, collate_fn=dataset.collate_fn)
+    report(fp32, int8, dataloader, args.batches)
@@ -0,0 +1,170 @@
+from __future__ import print_function, division
+import json
+import os
+import shutil
+import numpy as np
+from loader import ngsimDataset, EMPTY1, EMPTY2
+from track_store import makeTmpDir, replaceDir
+
+CACHE_VERSION = 1
+
+
+## Default cache location: one directory per (t_h, t_f, d_s, grid_size) next to the .mat file
+def cacheDir(mat_file, t_h=30, t_f=50, d_s=2, grid_size=(13, 3)):
+    key = 'th{}_tf{}_ds{}_grid{}x{}'.format(t_h, t_f, d_s, grid_size[0], grid_size[1])
+    return os.path.join(os.path.splitext(mat_file)[0] + '_cache', key)
+
+
+def cacheMeta(mat_file, t_h, t_f, d_s, grid_size):
+    stat = os.stat(mat_file)
+    return {'version': CACHE_VERSION, 't_h': t_h, 't_f': t_f, 'd_s': d_s, 'grid_size': list(grid_size),
+            'mat_size': stat.st_size, 'mat_mtime': stat.st_mtime_ns}
+
+
+def isCacheValid(cache_dir, meta):
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return all(saved.get(k) == v for k, v in meta.items())
+
+
+## One-time conversion of a .mat file into fixed-shape .npy arrays that can be memory-mapped:
+## ego features are (N, len, ...) with their valid lengths, neighbour features are packed
+## (M, len, ...) arrays with per-sample offsets and the grid cell of every neighbour.
+def buildSampleCache(mat_file, cache_dir=None, t_h=30, t_f=50, d_s=2, enc_size=64, grid_size=(13, 3)):
+    cache_dir = cache_dir or cacheDir(mat_file, t_h, t_f, d_s, grid_size)
+    dataset = ngsimDataset(mat_file, t_h, t_f, d_s, enc_size, grid_size)
+    n = len(dataset)
+    maxlen = t_h // d_s + 1
+    futlen = t_f // d_s
+    # every occupied grid entry yields at most one neighbour window
+    capacity = int(np.count_nonzero(dataset.D[:, 11:]))
+
+    tmp_dir = makeTmpDir(cache_dir)
+    meta = cacheMeta(mat_file, t_h, t_f, d_s, grid_size)
+
+    def array(name, dtype, shape):
+        return np.lib.format.open_memmap(os.path.join(tmp_dir, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+
+    try:
+        hist = array('hist', np.float32, (n, maxlen, 2))
+        hist_len = array('hist_len', np.int16, (n,))
+        fut = array('fut', np.float32, (n, futlen, 2))
+        fut_len = array('fut_len', np.int16, (n,))
+        va = array('va', np.float32, (n, maxlen, 2))
+        lane = array('lane', np.float32, (n, maxlen))
+        cls = array('cls', np.float32, (n, maxlen))
+        nbr_offset = array('nbr_offset', np.int64, (n + 1,))
+        nbr_hist = array('nbr_hist', np.float32, (capacity, maxlen, 2))
+        nbr_va = array('nbr_va', np.float32, (capacity, maxlen, 2))
+        nbr_lane = array('nbr_lane', np.float32, (capacity, maxlen, 1))
+        nbr_cls = array('nbr_cls', np.float32, (capacity, maxlen, 1))
+        nbr_dis = array('nbr_dis', np.float32, (capacity, maxlen, 1))
+        nbr_cell = array('nbr_cell', np.int8, (capacity,))
+        np.save(os.path.join(tmp_dir, 'key.npy'), dataset.D[:, 0:3])
+        np.save(os.path.join(tmp_dir, 'grid.npy'), dataset.D[:, 11:].astype(np.int32))
+        np.save(os.path.join(tmp_dir, 'lat.npy'), (dataset.D[:, 9] - 1).astype(np.int8))
+        np.save(os.path.join(tmp_dir, 'lon.npy'), (dataset.D[:, 10] - 1).astype(np.int8))
+
+        count = 0
+        for idx in range(n):
+            h, f, nbrs, _, _, v, nbrsva, l, nbrslane, _, nbrsdis, c, nbrscls = dataset[idx]
+            hist[idx, :len(h)] = h
+            hist_len[idx] = len(h)
+            fut[idx, :len(f)] = f
+            fut_len[idx] = len(f)
+            va[idx, :len(v)] = v
+            lane[idx, :len(l)] = l
+            cls[idx, :len(c)] = c
+            nbr_offset[idx] = count
+            for cell, nbr in enumerate(nbrs):
+                if len(nbr) != 0:
+                    nbr_hist[count] = nbr
+                    nbr_va[count] = nbrsva[cell]
+                    nbr_lane[count] = nbrslane[cell]
+                    nbr_cls[count] = nbrscls[cell]
+                    nbr_dis[count] = nbrsdis[cell]
+                    nbr_cell[count] = cell
+                    count += 1
+        nbr_offset[n] = count
+        for a in (hist, hist_len, fut, fut_len, va, lane, cls, nbr_offset, nbr_hist, nbr_va, nbr_lane, nbr_cls,
+                  nbr_dis, nbr_cell):
+            a.flush()
+
+        meta['num_samples'] = n
+        meta['num_neighbors'] = count
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    replaceDir(tmp_dir, cache_dir, lambda path: isCacheValid(path, meta))
+    return cache_dir
+
+
+## Dataset over a sample cache: __getitem__ returns views into the memory-mapped (copy-on-write) arrays
+## in the same layout as ngsimDataset (float32 instead of float64, which collate_fn casts to anyway)
+class ngsimCacheDataset(ngsimDataset):
+
+    def __init__(self, mat_file, t_h=30, t_f=50, d_s=2, enc_size=64, grid_size=(13, 3), cache_dir=None):
+        self.t_h = t_h
+        self.t_f = t_f
+        self.d_s = d_s
+        self.enc_size = enc_size
+        self.grid_size = grid_size
+        self.alltime = 0
+        self.count = 0
+        self.cache_dir = cache_dir or cacheDir(mat_file, t_h, t_f, d_s, grid_size)
+        if not isCacheValid(self.cache_dir, cacheMeta(mat_file, t_h, t_f, d_s, grid_size)):
+            buildSampleCache(mat_file, self.cache_dir, t_h, t_f, d_s, enc_size, grid_size)
+        with open(os.path.join(self.cache_dir, 'meta.json')) as f:
+            num_neighbors = json.load(f)['num_neighbors']
+        for name in ('hist', 'hist_len', 'fut', 'fut_len', 'va', 'lane', 'cls', 'key', 'grid', 'lat', 'lon',
+                     'nbr_offset'):
+            setattr(self, name, self.open(name))
+        for name in ('nbr_hist', 'nbr_va', 'nbr_lane', 'nbr_cls', 'nbr_dis', 'nbr_cell'):
+            setattr(self, name, self.open(name)[:num_neighbors])
+
+    ## plain ndarray view of the mapping, slicing np.memmap objects is noticeably slower
+    def open(self, name):
+        return np.asarray(np.load(os.path.join(self.cache_dir, name + '.npy'), mmap_mode='c'))
+
+    def __len__(self):
+        return len(self.key)
+
+    def gridIds(self):
+        return self.grid
+
+    def sampleKeys(self, indices):
+        return self.key[indices].astype(np.int64)
+
+    def __getitem__(self, idx):
+        h = self.hist_len[idx]
+        hist = self.hist[idx, :h]
+        fut = self.fut[idx, :self.fut_len[idx]]
+        va = self.va[idx, :h]
+        lane = self.lane[idx, :h]
+        cclass = self.cls[idx, :h]
+        refdistance = np.zeros([h, 1])
+
+        cells = self.grid_size[0] * self.grid_size[1]
+        neighbors = [EMPTY2] * cells
+        neighborsva = [EMPTY2] * cells
+        neighborslane = [EMPTY1] * cells
+        neighborsclass = [EMPTY1] * cells
+        neighborsdistance = [EMPTY1] * cells
+        start = self.nbr_offset[idx]
+        for j, cell in enumerate(self.nbr_cell[start:self.nbr_offset[idx + 1]].tolist(), start):
+            neighbors[cell] = self.nbr_hist[j]
+            neighborsva[cell] = self.nbr_va[j]
+            neighborslane[cell] = self.nbr_lane[j]
+            neighborsclass[cell] = self.nbr_cls[j]
+            neighborsdistance[cell] = self.nbr_dis[j]
+
+        lon_enc = np.zeros([3])
+        lon_enc[self.lon[idx]] = 1
+        lat_enc = np.zeros([3])
+        lat_enc[self.lat[idx]] = 1
+        return hist, fut, neighbors, lat_enc, lon_enc, va, neighborsva, lane, neighborslane, refdistance, neighborsdistance, cclass, neighborsclass
@@ -0,0 +1,140 @@
+from __future__ import print_function, division
+import numpy as np
+import torch
+from loader import gridCell, NBR_FEATURES
+from inference import forwardPacked
+
+## Per-frame vehicle state columns, the track columns [x, y, v, a, lane, class] of the .mat files
+STATE_COLUMNS = ('x', 'y', 'v', 'a', 'lane', 'class')
+
+
+## Online prediction from frame-by-frame vehicle states. Every vehicle has a fixed-size ring buffer of its
+## last t_h + 1 states, so building the history windows costs the same whatever the track length; all
+## vehicles with a full history are predicted together in one forward pass after each frame.
+## The windows, neighbours and masks are the ones ngsimDataset builds from the complete tracks.
+class StreamingPredictor(object):
+
+    def __init__(self, net, t_h=30, d_s=2, grid_size=(13, 3), device='cpu', capacity=256, max_age=10):
+        self.net = net
+        self.t_h = t_h
+        self.d_s = d_s
+        self.grid_size = grid_size
+        self.device = device
+        self.max_age = max_age  # frames without an update before a vehicle's buffer is released
+        self.length = t_h + 1
+        self.offsets = np.arange(-t_h, 1, d_s)  # window rows relative to the newest state
+        self.slots = {}  # vehId -> ring buffer slot
+        self.free = list(range(capacity))[::-1]
+        self.buffer = np.zeros((capacity, self.length, len(STATE_COLUMNS)))
+        self.head = np.zeros(capacity, dtype=np.int64)  # row of the newest state
+        self.count = np.zeros(capacity, dtype=np.int64)
+        self.last_frame = np.full(capacity, -np.inf)
+        self.frame = None
+        self.current = np.empty(0, dtype=np.int64)
+        self.grid = np.zeros((0, grid_size[0] * grid_size[1]), dtype=np.int64)
+
+    def grow(self):
+        capacity = len(self.buffer)
+        self.buffer = np.concatenate((self.buffer, np.zeros_like(self.buffer)))
+        self.head = np.concatenate((self.head, np.zeros(capacity, dtype=np.int64)))
+        self.count = np.concatenate((self.count, np.zeros(capacity, dtype=np.int64)))
+        self.last_frame = np.concatenate((self.last_frame, np.full(capacity, -np.inf)))
+        self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def release(self, frame):
+        for vehId, slot in list(self.slots.items()):
+            if frame - self.last_frame[slot] > self.max_age:
+                del self.slots[vehId]
+                self.count[slot] = 0
+                self.last_frame[slot] = -np.inf
+                self.free.append(slot)
+
+    ## States (n, 6) of the vehicles vehIds observed at frame. grid: optional (n, 39) neighbour vehIds per
+    ## vehicle (the traj grid columns); by default it is computed from the current lanes and positions.
+    def update(self, frame, vehIds, states, grid=None):
+        self.release(frame)
+        vehIds = np.asarray(vehIds, dtype=np.int64)
+        slots = np.empty(len(vehIds), dtype=np.int64)
+        for i, vehId in enumerate(vehIds.tolist()):
+            slot = self.slots.get(vehId)
+            if slot is None:
+                if not self.free:
+                    self.grow()
+                slot = self.slots[vehId] = self.free.pop()
+            slots[i] = slot
+        self.head[slots] = (self.head[slots] + 1) % self.length
+        self.buffer[slots, self.head[slots]] = states
+        self.count[slots] += 1
+        self.last_frame[slots] = frame
+        self.frame = frame
+        self.current = vehIds
+        self.grid = np.asarray(grid, dtype=np.int64) if grid is not None else self.liveGrid(vehIds, states)
+
+    ## 13 x 3 occupancy grids of the current vehicles by the NGSIM grid rule, entries are neighbour vehIds
+    def liveGrid(self, vehIds, states):
+        lane = states[:, STATE_COLUMNS.index('lane')]
+        y = states[:, STATE_COLUMNS.index('y')]
+        cells = gridCell((lane[None, :] - lane[:, None]).astype(int), y[None, :] - y[:, None])
+        np.fill_diagonal(cells, -1)
+        ego, nbr = np.nonzero(cells >= 0)
+        grid = np.zeros((len(vehIds), self.grid_size[0] * self.grid_size[1]), dtype=np.int64)
+        grid[ego, cells[ego, nbr]] = vehIds[nbr]
+        return grid
+
+    ## Boolean mask of the vehicles (buffer slots) observed at the current frame with a full history
+    def isReady(self, slots):
+        return (self.count[slots] >= self.length) & (self.last_frame[slots] == self.frame)
+
+    def windows(self, slots):
+        return self.buffer[slots[:, None], (self.head[slots, None] + self.offsets) % self.length]
+
+    ## Batch of the ready current vehicles in the collate_fn_packed layout (without future and maneuvers):
+    ## hist, nbrs, nbr_index, occupancy, va, lane, distance, class
+    def collate(self):
+        slots = np.array([self.slots[vehId] for vehId in self.current.tolist()], dtype=np.int64)
+        ready = self.isReady(slots)
+        vehIds, slots, grid = self.current[ready], slots[ready], self.grid[ready]
+        ego = self.windows(slots)  # (batch, len, 6)
+        refPos = self.buffer[slots, self.head[slots], 0:2]
+        hist = ego[:, :, 0:2] - refPos[:, None]
+
+        # neighbours with a full history at this frame, in (sample, cell) order as in collate_fn
+        nbr_slots = np.array([self.slots.get(vehId, -1) for vehId in grid.ravel().tolist()], dtype=np.int64)
+        valid = (grid.ravel() != 0) & (nbr_slots >= 0)
+        valid[valid] = self.isReady(nbr_slots[valid])
+        sample_ids, cell_ids = np.divmod(np.flatnonzero(valid), grid.shape[1])
+        nbr = self.windows(nbr_slots[valid])
+        nbr_hist = nbr[:, :, 0:2] - refPos[sample_ids, None]
+        distance = np.sqrt(np.power(hist[sample_ids] - nbr_hist, 2).sum(2))
+
+        packed = np.concatenate((nbr_hist, nbr[:, :, 2:5], distance[:, :, None], nbr[:, :, 5:6]), 2)
+        assert packed.shape[2] == len(NBR_FEATURES)
+        nbr_index = torch.from_numpy(np.stack((sample_ids, cell_ids), 1))
+        occupancy = torch.zeros(len(slots), self.grid_size[1], self.grid_size[0], dtype=torch.bool)
+        occupancy[nbr_index[:, 0], nbr_index[:, 1] // self.grid_size[0], nbr_index[:, 1] % self.grid_size[0]] = True
+        hist_batch = torch.from_numpy(hist.transpose(1, 0, 2)).float()
+        nbrs_batch = torch.from_numpy(packed.transpose(1, 0, 2)).float()
+        va_batch = torch.from_numpy(ego[:, :, 2:4].transpose(1, 0, 2)).float()
+        lane_batch = torch.from_numpy(ego[:, :, 4:5].transpose(1, 0, 2)).float()
+        distance_batch = torch.zeros_like(lane_batch)
+        class_batch = torch.from_numpy(ego[:, :, 5:6].transpose(1, 0, 2)).float()
+        return vehIds, (hist_batch, nbrs_batch, nbr_index, occupancy, va_batch, lane_batch, distance_batch,
+                        class_batch)
+
+    ## Predictions for every current vehicle with a full history: vehIds and Net outputs (trajectories are
+    ## relative to each vehicle's current position). maneuver='all' returns the 9 maneuver-conditioned
+    ## trajectories, maneuver='pred' only the most likely maneuver's one. There are no ground-truth maneuvers
+    ## when streaming, so 'true' is rejected.
+    def predict(self, maneuver='all'):
+        if maneuver not in ('all', 'pred'):
+            raise ValueError("streaming prediction supports maneuver='all' or 'pred', not {!r}".format(maneuver))
+        vehIds, batch = self.collate()
+        if len(vehIds) == 0:
+            return vehIds, None, None, None
+        hist, nbrs, nbr_index, occupancy, va, _, _, cls = [x.to(self.device) for x in batch]
+        lat_enc = torch.zeros(len(vehIds), 3, device=self.device)
+        lon_enc = torch.zeros(len(vehIds), 3, device=self.device)
+        with torch.no_grad():
+            fut_pred, lat_pred, lon_pred = forwardPacked(self.net, hist, nbrs, nbr_index, occupancy, va, cls, lat_enc,
+                                                         lon_enc, maneuver)
+        return vehIds, fut_pred, lat_pred, lon_pred
@@ -0,0 +1,104 @@
+from __future__ import print_function, division
+import argparse
+import numpy as np
+import scipy.io as scp
+from loader import gridCell
+
+parser = argparse.ArgumentParser(description='Synthetic NGSIM-like scenes:')
+parser.add_argument('out', type=str, help='.mat file to write')
+parser.add_argument('--datasets', type=int, default=2, help='number of recordings (dsId)')
+parser.add_argument('--frames', type=int, default=2000, help='frames per recording (10 Hz)')
+parser.add_argument('--lanes', type=int, default=6)
+parser.add_argument('--density', type=float, default=1.0, help='mean vehicles per lane per 100 ft')
+parser.add_argument('--stride', type=int, default=10, help='one traj row every stride frames of a vehicle')
+parser.add_argument('--seed', type=int, default=0)
+
+ROAD_LENGTH = 1600.0  # ft
+LANE_WIDTH = 12.0  # ft
+
+
+## One vehicle: (7, frames) track [frame, x, y, v, a, lane, class] from entering the road to leaving it,
+## with a noisy speed profile, at most one braking / accelerating episode and at most one lane change
+def simulateVehicle(rng, f0, lanes, frames):
+    speed = rng.uniform(20, 70)  # ft/s
+    n = min(int(ROAD_LENGTH / speed * 10), frames - f0)
+    accel = np.cumsum(rng.normal(0, 0.3, n)) * 0.1
+    v = speed + accel - accel.mean()
+    if rng.random() < 0.3:  # braking or accelerating episode
+        start = rng.integers(0, n)
+        v = v * (1 + np.clip((np.arange(n) - start) / 50.0, 0, 1) * rng.choice([-0.4, 0.4]))
+    v = np.clip(v, 0, None)
+    y = np.cumsum(v) * 0.1
+    lane = np.full(n, rng.integers(1, lanes + 1), dtype=float)
+    x = (lane - 0.5) * LANE_WIDTH + rng.normal(0, 0.3, n)
+    if n > 80 and rng.random() < 0.3:
+        target = lane[0] + rng.choice([-1, 1])
+        if 1 <= target <= lanes:
+            start = rng.integers(0, n - 40)
+            shift = np.clip((np.arange(n) - start) / 40.0, 0, 1) * (target - lane[0]) * LANE_WIDTH
+            x = x + shift
+            lane[start + 20:] = target
+    cls = np.full(n, rng.choice([1, 2, 3], p=[0.02, 0.9, 0.08]), dtype=float)
+    return np.stack([np.arange(f0, f0 + n, dtype=float), x, y, v, np.gradient(v) * 10, lane, cls])
+
+
+## Maneuver classes of frame r of a track: lateral 1 keep / 2 left / 3 right lane change within +-4 s,
+## longitudinal 1 normal / 2 braking / 3 accelerating over the next 5 s
+def maneuvers(track, r):
+    lane = track[5]
+    before, after = lane[max(0, r - 40)], lane[min(len(lane) - 1, r + 40)]
+    lat = 1 if before == after else (2 if after < before else 3)
+    future = track[3, r + 1:r + 51]
+    ratio = future.mean() / max(track[3, max(0, r - 30):r + 1].mean(), 1e-3) if len(future) else 1
+    lon = 2 if ratio < 0.8 else (3 if ratio > 1.2 else 1)
+    return lat, lon
+
+
+## traj / tracks structures in the layout of the NGSIM .mat files read by ngsimDataset: traj rows are
+## [dsId, vehId, frame, x, y, lane, 0, 0, 0, lat, lon, 39 grid vehIds], tracks[ds, veh] is a (7, frames) array.
+## density is the expected number of vehicles per lane per 100 ft, which sets how many grid cells are occupied.
+def makeScenes(datasets=2, frames=2000, lanes=6, density=1.0, stride=10, seed=0):
+    rng = np.random.default_rng(seed)
+    per_frame = density * lanes * 45.0 / 100.0 / 10.0  # arrivals per frame at a mean speed of 45 ft/s
+    all_tracks = []
+    for ds in range(datasets):
+        arrivals = np.sort(rng.integers(0, frames - 50, rng.poisson(per_frame * frames)))
+        all_tracks.append([simulateVehicle(rng, f0, lanes, frames) for f0 in arrivals])
+    tracks = np.empty((datasets, max(len(v) for v in all_tracks)), dtype=object)
+    for ds in range(datasets):
+        for veh in range(tracks.shape[1]):
+            tracks[ds, veh] = all_tracks[ds][veh] if veh < len(all_tracks[ds]) else np.zeros((0, 0))
+
+    rows = []
+    for ds, vehicles in enumerate(all_tracks):
+        # (vehId, frame, y, lane) of every observation, to find the vehicles around a sample per frame
+        obs = np.concatenate([np.stack([np.full(tr.shape[1], veh + 1), tr[0], tr[2], tr[5]], 1)
+                              for veh, tr in enumerate(vehicles)])
+        obs = obs[np.argsort(obs[:, 1], kind='stable')]
+        bounds = np.searchsorted(obs[:, 1], np.arange(frames + 1))
+        for veh, tr in enumerate(vehicles):
+            for r in range(30, tr.shape[1] - 1, stride):
+                frame = int(tr[0, r])
+                others = obs[bounds[frame]:bounds[frame + 1]]
+                others = others[others[:, 0] != veh + 1]
+                cells = gridCell((others[:, 3] - tr[5, r]).astype(int), others[:, 2] - tr[2, r])
+                grid = np.zeros(39)
+                grid[cells[cells >= 0]] = others[cells >= 0, 0]
+                lat, lon = maneuvers(tr, r)
+                rows.append(np.concatenate([[ds + 1, veh + 1, frame, tr[1, r], tr[2, r], tr[5, r], 0, 0, 0, lat, lon],
+                                            grid]))
+    return np.array(rows), tracks
+
+
+def writeScenes(path, **kwargs):
+    traj, tracks = makeScenes(**kwargs)
+    scp.savemat(path, {'traj': traj, 'tracks': tracks})
+    return traj, tracks
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    traj, tracks = writeScenes(args.out, datasets=args.datasets, frames=args.frames, lanes=args.lanes,
+                               density=args.density, stride=args.stride, seed=args.seed)
+    print('{} samples, {} vehicles, {:.1f} neighbours per sample'.format(
+        len(traj), sum(tr.size > 0 for tr in tracks.ravel()), np.count_nonzero(traj[:, 11:]) / max(len(traj), 1)))
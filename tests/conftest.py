@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loader import ngsimDataset
+from synthetic import writeScenes
+
+## Constructor arguments of the pre-trained NGSIM model
+NET_ARGS = {'use_cuda': False, 'train_flag': False, 'use_maneuvers': True, 'use_true_man': True, 'in_length': 16,
+            'out_length': 25, 'num_lat_classes': 3, 'num_lon_classes': 3, 'num_features': 5, 'num_opt': 0,
+            'ff_hidden_size': 256, 'lstm_encoder_size': 64, 'decoder_size': 128, 'num_blocks': 4, 'num_heads': 8,
+            'input_embed_size': 32, 'soc_conv_depth': 64, 'conv_3x1_depth': 16, 'att_out_size': 32}
+
+
+## Small generated scene set in the TestSet.mat layout, dense enough that most grids have several neighbours
+@pytest.fixture(scope='session')
+def mat_file(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('data') / 'scenes.mat')
+    writeScenes(path, datasets=1, frames=300, density=1.5, stride=50, seed=0)
+    return path
+
+
+@pytest.fixture(scope='session')
+def dataset(mat_file):
+    return ngsimDataset(mat_file)
+
+
+## Net with seeded random weights; needs the compiled model code
+@pytest.fixture(scope='session')
+def net():
+    model = pytest.importorskip('model')
+    torch.manual_seed(0)
+    return model.Net(argparse.Namespace(**NET_ARGS)).eval()
+
+
+## collate_fn batch of the first samples
+@pytest.fixture(scope='session')
+def batch(dataset):
+    return dataset.collate_fn([dataset[i] for i in range(min(64, len(dataset)))])
+
+
+## evaluate.py parses its arguments on import, so it is imported with the defaults
+@pytest.fixture(scope='session')
+def evaluate_module():
+    argv = sys.argv
+    sys.argv = ['evaluate.py']
+    try:
+        import evaluate
+    finally:
+        sys.argv = argv
+    return evaluate
+
+
+## run(evaluator=None, **options): Evaluate.main on the generated scenes with the Net fixture saved as a
+## checkpoint and the given evaluate.py arguments (defaults otherwise). Returns the printed lines without the
+## timings and progress, which differ between runs.
+@pytest.fixture
+def run_evaluation(evaluate_module, net, mat_file, tmp_path, monkeypatch, capsys):
+    from checkpoint import saveCheckpoint
+    model = str(tmp_path / 'net.ckpt')
+    saveCheckpoint(net, model)
+    defaults = vars(evaluate_module.net_args)
+
+    def run(evaluator=None, **options):
+        args = dict(defaults, model=model, test_set=mat_file, batch_size=32, num_workers=0)
+        args.update(options)
+        monkeypatch.setattr(evaluate_module, 'net_args', argparse.Namespace(**args))
+        capsys.readouterr()
+        (evaluator or evaluate_module.Evaluate()).main(val=False)
+        return [line for line in capsys.readouterr().out.splitlines()
+                if 'time' not in line and not line.startswith(('process:', 'pipelined loop'))]
+    return run
@@ -0,0 +1,38 @@
+import numpy as np
+import torch
+from loader import NeighborBucketSampler, unpackNeighbors
+from inference import forwardManeuver, neighborCells
+from sample_cache import ngsimCacheDataset
+
+
+def test_every_sample_in_one_batch(dataset, mat_file, tmp_path):
+    cached = ngsimCacheDataset(mat_file, cache_dir=str(tmp_path / 'cache'))
+    for data in (dataset, cached):
+        sampler = NeighborBucketSampler(data, 32)
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert sorted(np.concatenate(batches).tolist()) == list(range(len(data)))
+        assert sampler.capacities == sorted(sampler.capacities)
+    assert NeighborBucketSampler(cached, 32).capacities == NeighborBucketSampler(dataset, 32).capacities
+
+
+def test_padded_batches_match_forward(net, dataset):
+    sampler = NeighborBucketSampler(dataset, 32)
+    batches = list(sampler)
+    padding = 0
+    for indices in (batches[0], batches[-1]):
+        samples = [dataset[i] for i in indices]
+        hist, nbrs, mask, lat_enc, lon_enc, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = dataset.collate_fn(samples)
+        p_hist, p_nbrs, nbr_index, occupancy, _, _, _, _, p_va, _, _, p_cls = dataset.collate_fn_packed(
+            samples, nbr_capacities=sampler.capacities)
+        assert p_nbrs.shape[1] in sampler.capacities
+        padding += p_nbrs.shape[1] - nbrs.shape[1]
+        p_nbrs, p_nbrsva, _, _, p_nbrscls, p_mask, _ = unpackNeighbors(p_nbrs, nbr_index, occupancy, net.encoder_size)
+        with torch.no_grad():
+            ref = net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+            out = forwardManeuver(net, p_hist, p_nbrs, p_mask, p_va, p_nbrsva, p_cls, p_nbrscls, lat_enc, lon_enc,
+                                  'all', neighborCells(nbr_index, len(samples)))
+        for a, b in zip(ref[0], out[0]):
+            assert torch.equal(a, b)
+        assert torch.equal(ref[1], out[1]) and torch.equal(ref[2], out[2])
+    assert padding > 0
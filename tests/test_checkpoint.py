@@ -0,0 +1,16 @@
+import copy
+import pytest
+import torch
+from checkpoint import isQuantized, loadModel, saveCheckpoint
+from quantize import quantizeNet
+
+
+def test_quantized_model_is_cpu_only(net, tmp_path):
+    path = str(tmp_path / 'net_int8.pth')
+    torch.save(quantizeNet(copy.deepcopy(net)), path)
+    assert isQuantized(loadModel(path)) and not isQuantized(net)
+    with pytest.raises(ValueError, match='CPU only'):
+        loadModel(path, torch.device('cuda:0'))
+    checkpoint = str(tmp_path / 'net.ckpt')
+    saveCheckpoint(net, checkpoint)
+    assert not isQuantized(loadModel(checkpoint))
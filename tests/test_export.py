@@ -0,0 +1,23 @@
+import torch
+from inference import exportNet, loadExported, maskCells
+
+
+def exportInputs(batch):
+    hist, nbrs, mask, _, _, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = batch
+    return hist, nbrs, mask, va, nbrsva, cls, nbrscls, maskCells(mask)
+
+
+def test_exported_program_matches_forward(net, dataset, batch, tmp_path):
+    path = str(tmp_path / 'net.pt2')
+    torch.export.save(exportNet(net, exportInputs(batch)), path)
+    exported = loadExported(path)
+    # a batch of another size and neighbour count runs through the same program
+    other = dataset.collate_fn([dataset[i] for i in range(len(dataset) - 17, len(dataset))])
+    for data in (batch, other):
+        hist, nbrs, mask, lat_enc, lon_enc, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = data
+        with torch.no_grad():
+            ref = net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+            out = exported(*exportInputs(data))
+        assert len(out[0]) == len(ref[0])
+        for a, b in zip(list(ref[0]) + list(ref[1:]), list(out[0]) + list(out[1:])):
+            torch.testing.assert_close(b, a, rtol=0, atol=1e-5)
@@ -0,0 +1,48 @@
+import torch
+from inference import forwardManeuver, prepareNet
+from metrics import selectManeuver
+
+
+def netInputs(batch):
+    hist, nbrs, mask, lat_enc, lon_enc, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = batch
+    return hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc
+
+
+def oneHot(probabilities):
+    return torch.zeros_like(probabilities).scatter_(1, probabilities.argmax(1, keepdim=True), 1)
+
+
+def test_all_maneuvers_match_forward(net, batch):
+    with torch.no_grad():
+        ref = net(*netInputs(batch))
+        out = forwardManeuver(net, *netInputs(batch), maneuver='all')
+    assert len(out[0]) == len(ref[0]) == net.num_lat_classes * net.num_lon_classes
+    for a, b in zip(ref[0], out[0]):
+        assert torch.equal(a, b)
+    assert torch.equal(ref[1], out[1]) and torch.equal(ref[2], out[2])
+
+
+def test_single_maneuver_matches_selected_forward(net, batch):
+    inputs = netInputs(batch)
+    lat_enc, lon_enc = inputs[-2:]
+    with torch.no_grad():
+        fut_pred, lat_pred, lon_pred = net(*inputs)
+        true = forwardManeuver(net, *inputs, maneuver='true')
+        pred = forwardManeuver(net, *inputs, maneuver='pred')
+    assert torch.equal(true[0], selectManeuver(fut_pred, lat_enc, lon_enc))
+    assert torch.equal(pred[0], selectManeuver(fut_pred, oneHot(lat_pred), oneHot(lon_pred)))
+    assert torch.equal(true[1], lat_pred) and torch.equal(pred[2], lon_pred)
+
+
+def test_bf16_autocast_follows_input_device(net, batch, monkeypatch):
+    devices = []
+    autocast = torch.autocast
+
+    def recordAutocast(device_type, **kwargs):
+        devices.append(device_type)
+        return autocast(device_type, **kwargs)
+    monkeypatch.setattr(torch, 'autocast', recordAutocast)
+    with torch.no_grad():
+        fut_pred, lat_pred, lon_pred = prepareNet(net, 'bf16')(*netInputs(batch))
+    assert devices and set(devices) == {'cpu'}
+    assert fut_pred[0].dtype == lat_pred.dtype == torch.float32
@@ -0,0 +1,30 @@
+import torch
+from loader import unpackNeighbors
+from inference import forwardPacked
+
+
+def test_packed_batch_matches_collate_fn(dataset):
+    samples = [dataset[i] for i in range(min(128, len(dataset)))]
+    hist, nbrs, mask, lat_enc, lon_enc, fut, op_mask, va, nbrsva, lane, nbrslane, dis, nbrsdis, cls, nbrscls, \
+        map_position = dataset.collate_fn(samples)
+    packed = dataset.collate_fn_packed(samples)
+    p_hist, p_nbrs, nbr_index, occupancy, p_lat_enc, p_lon_enc, p_fut, p_op_mask, p_va, p_lane, p_dis, p_cls = packed
+    assert occupancy.any() and not occupancy.all()
+    unpacked = unpackNeighbors(p_nbrs, nbr_index, occupancy, mask.shape[3])
+    for ref, out in zip((nbrs, nbrsva, nbrslane, nbrsdis, nbrscls, mask, map_position), unpacked):
+        assert torch.equal(ref, out)
+    for ref, out in zip((hist, lat_enc, lon_enc, fut, op_mask, va, lane, dis, cls),
+                        (p_hist, p_lat_enc, p_lon_enc, p_fut, p_op_mask, p_va, p_lane, p_dis, p_cls)):
+        assert torch.equal(ref, out)
+
+
+def test_forward_packed_matches_forward(net, dataset, batch):
+    hist, nbrs, mask, lat_enc, lon_enc, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = batch
+    p_hist, p_nbrs, nbr_index, occupancy, _, _, _, _, p_va, _, _, p_cls = dataset.collate_fn_packed(
+        [dataset[i] for i in range(hist.shape[1])])
+    with torch.no_grad():
+        ref = net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+        out = forwardPacked(net, p_hist, p_nbrs, nbr_index, occupancy, p_va, p_cls, lat_enc, lon_enc)
+    for a, b in zip(ref[0], out[0]):
+        assert torch.equal(a, b)
+    assert torch.equal(ref[1], out[1]) and torch.equal(ref[2], out[2])
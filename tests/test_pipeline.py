@@ -0,0 +1,55 @@
+import pytest
+from test_prediction_store import Interrupted, InterruptedWriter, assertSameMetrics, assertSamePredictions
+
+LAYOUTS = ({}, {'packed_batch': True}, {'bucket_batch': True}, {'scene_batch': True})
+
+
+def outputs(tmp_path, name):
+    return {'stratified_metrics': True, 'metrics_out': str(tmp_path / (name + '.pt')),
+            'predictions_out': str(tmp_path / name), 'predictions_chunk': 64}
+
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+def test_pipelined_run_matches_sequential(run_evaluation, tmp_path, layout):
+    sequential = run_evaluation(**dict(outputs(tmp_path, 'sequential'), **layout))
+    pipelined = run_evaluation(pipeline=True, **dict(outputs(tmp_path, 'pipelined'), **layout))
+    assert pipelined == sequential
+    assertSamePredictions(str(tmp_path / 'sequential'), str(tmp_path / 'pipelined'))
+    assertSameMetrics(str(tmp_path / 'sequential.pt'), str(tmp_path / 'pipelined.pt'))
+
+
+def test_resumed_pipelined_run_matches_sequential(run_evaluation, evaluate_module, tmp_path, monkeypatch):
+    sequential = run_evaluation(**outputs(tmp_path, 'sequential'))
+    with monkeypatch.context() as m:
+        m.setattr(evaluate_module, 'PredictionWriter', InterruptedWriter)
+        with pytest.raises(Interrupted):
+            run_evaluation(pipeline=True, **outputs(tmp_path, 'pipelined'))
+    resumed = run_evaluation(pipeline=True, **outputs(tmp_path, 'pipelined'))
+    assert resumed[0].startswith('resuming') and resumed[1:] == sequential
+    assertSamePredictions(str(tmp_path / 'sequential'), str(tmp_path / 'pipelined'))
+    assertSameMetrics(str(tmp_path / 'sequential.pt'), str(tmp_path / 'pipelined.pt'))
+
+
+def test_repeated_evaluation_reuses_workers(run_evaluation, evaluate_module):
+    evaluator = evaluate_module.Evaluate()
+    first = run_evaluation(evaluator, pipeline=True, num_workers=1)
+    loader, = [entry[0] for entry in evaluator.loaders.values()]
+    workers = [w.pid for w in loader._iterator._workers]
+    assert run_evaluation(evaluator, pipeline=True, num_workers=1) == first
+    assert [entry[0] for entry in evaluator.loaders.values()] == [loader]
+    assert [w.pid for w in loader._iterator._workers] == workers
+
+
+def test_failed_pipelined_run_closes_its_worker(run_evaluation, evaluate_module, tmp_path, monkeypatch):
+    workers = []
+
+    class RecordedWorker(evaluate_module.SerialWorker):
+        def __init__(self, *args):
+            super(RecordedWorker, self).__init__(*args)
+            workers.append(self)
+    monkeypatch.setattr(evaluate_module, 'SerialWorker', RecordedWorker)
+    monkeypatch.setattr(evaluate_module, 'PredictionWriter', InterruptedWriter)
+    with pytest.raises(Interrupted):
+        run_evaluation(pipeline=True, predictions_out=str(tmp_path / 'predictions'), predictions_chunk=64)
+    worker, = workers
+    assert worker.executor._shutdown and not worker.pending
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+import prediction_store
+from metrics import SUMS
+from prediction_store import readPredictions
+
+
+class Interrupted(Exception):
+    pass
+
+
+## PredictionWriter that stops the evaluation after its second chunk
+class InterruptedWriter(prediction_store.PredictionWriter):
+
+    def flush(self, state):
+        super(InterruptedWriter, self).flush(state)
+        if self.chunks == 2:
+            raise Interrupted()
+
+
+def assertSamePredictions(ref_dir, out_dir):
+    ref, out = readPredictions(ref_dir), readPredictions(out_dir)
+    for name in prediction_store.PREDICTION_ARRAYS:
+        np.testing.assert_array_equal(ref[name], out[name])
+
+
+def assertSameMetrics(ref_file, out_file):
+    ref, out = torch.load(ref_file), torch.load(out_file)
+    for name in SUMS:
+        assert torch.equal(ref[name], out[name])
+
+
+def test_resumed_run_matches_uninterrupted(run_evaluation, evaluate_module, tmp_path, monkeypatch):
+    options = dict(stratified_metrics=True, predictions_chunk=64)
+    full = run_evaluation(predictions_out=str(tmp_path / 'full'), metrics_out=str(tmp_path / 'full.pt'), **options)
+    out_dir = str(tmp_path / 'resumed')
+    with monkeypatch.context() as m:
+        m.setattr(evaluate_module, 'PredictionWriter', InterruptedWriter)
+        with pytest.raises(Interrupted):
+            run_evaluation(predictions_out=out_dir, metrics_out=str(tmp_path / 'resumed.pt'), **options)
+    assert len(readPredictions(out_dir)['keys']) == 128
+    resumed = run_evaluation(predictions_out=out_dir, metrics_out=str(tmp_path / 'resumed.pt'), **options)
+    assert resumed[0].startswith('resuming') and resumed[1:] == full
+    assertSamePredictions(str(tmp_path / 'full'), out_dir)
+    assertSameMetrics(str(tmp_path / 'full.pt'), str(tmp_path / 'resumed.pt'))
+
+
+def test_resume_rejects_other_configuration(run_evaluation, tmp_path):
+    out_dir = str(tmp_path / 'predictions')
+    run_evaluation(predictions_out=out_dir, predictions_chunk=64)
+    for options in ({'out_length': 20}, {'grid_size': [13, 5]}, {'batch_size': 64}):
+        with pytest.raises(ValueError):
+            run_evaluation(predictions_out=out_dir, predictions_chunk=64, **options)
+
+
+## A run that resumed a store doesn't carry its starting batch over to the next main() call
+def test_evaluator_reused_after_resume(run_evaluation, evaluate_module, tmp_path, monkeypatch):
+    full = run_evaluation(pipeline=True)
+    out_dir = str(tmp_path / 'predictions')
+    with monkeypatch.context() as m:
+        m.setattr(evaluate_module, 'PredictionWriter', InterruptedWriter)
+        with pytest.raises(Interrupted):
+            run_evaluation(predictions_out=out_dir, predictions_chunk=64)
+    evaluator = evaluate_module.Evaluate()
+    resumed = run_evaluation(evaluator, pipeline=True, predictions_out=out_dir, predictions_chunk=64)
+    assert resumed[0].startswith('resuming')
+    assert run_evaluation(evaluator, pipeline=True) == full
@@ -0,0 +1,44 @@
+import multiprocessing
+import numpy as np
+import torch
+from sample_cache import ngsimCacheDataset, buildSampleCache
+
+
+def test_cache_batches_match_dataset(dataset, mat_file, tmp_path):
+    cached = ngsimCacheDataset(mat_file, cache_dir=str(tmp_path / 'cache'))
+    assert len(cached) == len(dataset)
+    np.testing.assert_array_equal(cached.sampleKeys(np.arange(len(cached))), dataset.sampleKeys(np.arange(len(dataset))))
+    np.testing.assert_array_equal(cached.trafficLevels(), dataset.trafficLevels())
+    indices = range(min(64, len(dataset)))
+    for ref, out in zip(dataset.collate_fn([dataset[i] for i in indices]),
+                        cached.collate_fn([cached[i] for i in indices])):
+        assert ref.dtype == out.dtype
+        assert torch.equal(ref, out)
+
+
+def test_cache_is_reused(dataset, mat_file, tmp_path):
+    cache_dir = tmp_path / 'cache'
+    ngsimCacheDataset(mat_file, cache_dir=str(cache_dir))
+    built = (cache_dir / 'hist.npy').stat().st_mtime_ns
+    reopened = ngsimCacheDataset(mat_file, cache_dir=str(cache_dir))
+    assert (cache_dir / 'hist.npy').stat().st_mtime_ns == built
+    assert len(reopened) == len(dataset)
+
+
+def buildCache(barrier, mat_file, cache_dir):
+    barrier.wait()
+    buildSampleCache(mat_file, cache_dir)
+
+
+def test_concurrent_builds(dataset, mat_file, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(4)
+    processes = [context.Process(target=buildCache, args=(barrier, mat_file, cache_dir)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 4
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['cache']
+    assert len(ngsimCacheDataset(mat_file, cache_dir=cache_dir)) == len(dataset)
@@ -0,0 +1,55 @@
+import copy
+import pytest
+import torch
+from loader import NeighborBucketSampler, unpackNeighbors
+from inference import forwardManeuver, maskCells, neighborCells
+from quantize import quantizeNet
+
+
+def assertOutputsClose(ref, out):
+    for a, b in zip(list(ref[0]) + list(ref[1:]), list(out[0]) + list(out[1:])):
+        torch.testing.assert_close(b, a, rtol=1e-4, atol=1e-5)
+
+
+def test_sparse_attention_matches_dense(net, batch):
+    hist, nbrs, mask, lat_enc, lon_enc, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = batch
+    occupied = mask[..., 0].flatten(1).sum(1)
+    assert (occupied > 0).any() and (occupied < mask[0, ..., 0].numel()).all()  # every sample has empty cells
+    with torch.no_grad():
+        ref = net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+        out = forwardManeuver(net, hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc, 'all',
+                              maskCells(mask), sparse_spatial=True)
+    assertOutputsClose(ref, out)
+
+
+def test_sparse_attention_on_padded_batch(net, dataset):
+    sampler = NeighborBucketSampler(dataset, 32)
+    samples = [dataset[i] for i in list(sampler)[0]]
+    hist, nbrs, mask, lat_enc, lon_enc, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = dataset.collate_fn(samples)
+    p_hist, p_nbrs, nbr_index, occupancy, _, _, _, _, p_va, _, _, p_cls = dataset.collate_fn_packed(
+        samples, nbr_capacities=sampler.capacities)
+    p_nbrs, p_nbrsva, _, _, p_nbrscls, p_mask, _ = unpackNeighbors(p_nbrs, nbr_index, occupancy, net.encoder_size)
+    with torch.no_grad():
+        ref = net(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+        out = forwardManeuver(net, p_hist, p_nbrs, p_mask, p_va, p_nbrsva, p_cls, p_nbrscls, lat_enc, lon_enc, 'all',
+                              neighborCells(nbr_index, len(samples)), sparse_spatial=True)
+    assertOutputsClose(ref, out)
+
+
+def test_sparse_attention_on_quantized_net(net, batch):
+    int8 = quantizeNet(copy.deepcopy(net))
+    hist, nbrs, mask, lat_enc, lon_enc, _, _, va, nbrsva, _, _, _, _, cls, nbrscls, _ = batch
+    with torch.no_grad():
+        ref = int8(hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc)
+        out = forwardManeuver(int8, hist, nbrs, mask, va, nbrsva, cls, nbrscls, lat_enc, lon_enc, 'all',
+                              maskCells(mask), sparse_spatial=True)
+    # the activations are quantized per tensor, so leaving out the empty cells shifts the rounding slightly
+    for a, b in zip(list(ref[0]) + list(ref[1:]), list(out[0]) + list(out[1:])):
+        torch.testing.assert_close(b, a, rtol=0, atol=1e-2)
+
+
+@pytest.mark.parametrize('options', ({'inference_backend': 'bf16'}, {'profile': True}))
+def test_evaluate_rejects_unsupported_options(run_evaluation, tmp_path, options):
+    with pytest.raises(ValueError, match='--sparse_spatial'):
+        run_evaluation(sparse_spatial=True, profile_dir=str(tmp_path / 'profile'), **options)
+    assert not (tmp_path / 'profile').exists()
@@ -0,0 +1,43 @@
+import numpy as np
+import torch
+from streaming import StreamingPredictor
+
+
+## Streaming batch rows of the given vehicles, in the collate_fn_packed layout and neighbour order
+def selectVehicles(vehIds, batch, selected):
+    hist, nbrs, nbr_index, occupancy, va, lane, _, cls = batch
+    rows = torch.as_tensor([vehIds.tolist().index(vehId) for vehId in selected])
+    sample_ids = torch.full((len(vehIds),), -1, dtype=torch.long)
+    sample_ids[rows] = torch.arange(len(rows))
+    keep = sample_ids[nbr_index[:, 0]] >= 0
+    nbr_index = torch.stack((sample_ids[nbr_index[keep, 0]], nbr_index[keep, 1]), 1)
+    order = torch.argsort(nbr_index[:, 0] * occupancy[0].numel() + nbr_index[:, 1])
+    return hist[:, rows], nbrs[:, keep][:, order], nbr_index[order], occupancy[rows], va[:, rows], lane[:, rows], \
+        cls[:, rows]
+
+
+## The live 13 x 3 grid and the ring buffer windows give the samples of the dataset at every frame
+def test_live_grid_collate_matches_packed_batch(dataset):
+    frames = {}
+    for vehId in range(1, dataset.tracks.shape[1] + 1):
+        for row in dataset.tracks.track(vehId, 1):
+            frames.setdefault(int(row[0]), []).append((vehId, row[1:7]))
+    samples = {}
+    for idx in range(len(dataset)):
+        samples.setdefault(int(dataset.D[idx, 2]), []).append(idx)
+    assert set(dataset.D[:, 0]) == {1}
+    predictor = StreamingPredictor(None, t_h=dataset.t_h, d_s=dataset.d_s, grid_size=dataset.grid_size, capacity=8)
+    compared = 0
+    for frame in sorted(frames):
+        vehIds, states = zip(*frames[frame])
+        predictor.update(frame, vehIds, np.array(states))
+        if frame not in samples:
+            continue
+        vehIds, batch = predictor.collate()
+        hist, nbrs, nbr_index, occupancy, _, _, _, _, va, lane, _, cls = dataset.collate_fn_packed(
+            [dataset[idx] for idx in samples[frame]])
+        out = selectVehicles(vehIds, batch, [int(dataset.D[idx, 1]) for idx in samples[frame]])
+        for ref, streamed in zip((hist, nbrs, nbr_index, occupancy, va, lane, cls), out):
+            assert torch.equal(ref, streamed)
+        compared += len(samples[frame])
+    assert compared == len(dataset)
@@ -0,0 +1,37 @@
+import multiprocessing
+import numpy as np
+from track_store import TrackStore, isStoreValid
+
+
+def test_get_row_matches_frame_scan():
+    tracks = np.empty((1, 3), dtype=object)
+    gaps = np.array([5, 6, 7, 10, 11, 15, 20, 21, 22])
+    for veh, frames in enumerate((np.arange(3, 12), gaps, np.zeros(0))):
+        tracks[0, veh] = np.vstack([frames, np.tile(np.arange(1, 7)[:, None], len(frames))])
+    store = TrackStore.fromTracks(np.zeros((0, 5)), tracks)
+    assert store.contiguous[0, 0] and not store.contiguous[0, 1]
+    for veh in (1, 2, 3):
+        frames = store.track(veh, 1)[:, 0]
+        for t in np.arange(0, 25, 0.5):
+            rows = np.flatnonzero(frames == t)
+            assert store.getRow(veh, t, 1) == (int(rows[0]) if len(rows) else -1)
+
+
+def buildStore(barrier, mat_file, path):
+    barrier.wait()
+    TrackStore.build(mat_file, path).track(1, 1)
+
+
+## Processes building the same store at once (e.g. the shards of a --world_size run) all end up with it
+def test_concurrent_builds(mat_file, tmp_path):
+    path = str(tmp_path / 'tracks')
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(4)
+    processes = [context.Process(target=buildStore, args=(barrier, mat_file, path)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 4
+    assert isStoreValid(path, mat_file)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['tracks']
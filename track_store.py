@@ -0,0 +1,159 @@
+from __future__ import print_function, division
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+STORE_VERSION = 1
+STORE_ARRAYS = ('traj', 'data', 'offset', 'length', 'frame0', 'contiguous')
+
+
+## Default store location next to the .mat file
+def storeDir(mat_file):
+    return os.path.splitext(mat_file)[0] + '_tracks'
+
+
+def storeMeta(mat_file):
+    stat = os.stat(mat_file)
+    return {'version': STORE_VERSION, 'mat_size': stat.st_size, 'mat_mtime': stat.st_mtime_ns}
+
+
+## New private directory next to path to write a store into; unique, so that concurrent builders of the
+## same store (e.g. the processes of a --world_size run) never write into each other's files
+def makeTmpDir(path):
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix=os.path.basename(path) + '.tmp')
+    os.chmod(tmp_path, 0o755)
+    return tmp_path
+
+
+## Moves the finished store tmp_path to path. When a concurrent builder has already put a valid store there
+## (valid(path)), that one is kept and tmp_path discarded, so processes that opened it keep their files.
+def replaceDir(tmp_path, path, valid):
+    if not valid(path):
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.replace(tmp_path, path)
+            return
+        except OSError:  # another builder replaced path in between
+            if not valid(path):
+                raise
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def isStoreValid(path, mat_file):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f) == storeMeta(mat_file)
+    except (OSError, ValueError):
+        return False
+
+
+## Columnar (CSR) layout of the .mat 'tracks' cell array: the (frames, 7) matrices of all vehicles are
+## stacked into one contiguous float array, with per-(dsId, vehId) row offsets and lengths. The 'traj'
+## sample table is kept next to it. Unlike the numpy object array returned by loadmat, touching a track
+## doesn't write to refcounts in shared pages, so forked DataLoader workers don't slowly copy the table;
+## an mmap-backed store is also pickled by path, so spawned workers attach to it instead of copying.
+class TrackStore(object):
+
+    def __init__(self, arrays, path=None):
+        self.path = path
+        for name in STORE_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.shape = self.offset.shape
+
+    @classmethod
+    def fromTracks(cls, traj, tracks, path=None):
+        length = np.zeros(tracks.shape, dtype=np.int64)
+        frame0 = np.zeros(tracks.shape, dtype=np.float64)
+        contiguous = np.ones(tracks.shape, dtype=bool)
+        ncols = 0
+        for ds in range(tracks.shape[0]):
+            for veh in range(tracks.shape[1]):
+                track = tracks[ds][veh]
+                if track.size == 0:
+                    continue
+                frames = track[0]
+                length[ds, veh] = len(frames)
+                frame0[ds, veh] = frames[0]
+                contiguous[ds, veh] = np.array_equal(frames, frames[0] + np.arange(len(frames)))
+                ncols = max(ncols, track.shape[0])
+        offset = np.zeros(tracks.shape, dtype=np.int64)
+        offset.flat[1:] = np.cumsum(length.ravel())[:-1]
+        data = np.zeros((int(length.sum()), ncols), dtype=np.float64)
+        for ds in range(tracks.shape[0]):
+            for veh in range(tracks.shape[1]):
+                if length[ds, veh]:
+                    track = tracks[ds][veh]
+                    data[offset[ds, veh]:offset[ds, veh] + length[ds, veh], :track.shape[0]] = track.transpose()
+        return cls({'traj': traj, 'data': data, 'offset': offset, 'length': length, 'frame0': frame0,
+                    'contiguous': contiguous}, path)
+
+    ## In-memory store of the traj / tracks of a .mat file
+    @classmethod
+    def read(cls, mat_file):
+        import scipy.io as scp
+        mat = scp.loadmat(mat_file, variable_names=('traj', 'tracks'))
+        return cls.fromTracks(mat['traj'], mat['tracks'])
+
+    ## Writes the store for mat_file to path (atomically) and returns it memory-mapped
+    @classmethod
+    def build(cls, mat_file, path=None):
+        path = path or storeDir(mat_file)
+        store = cls.read(mat_file)
+        tmp_path = makeTmpDir(path)
+        try:
+            for name in STORE_ARRAYS:
+                np.save(os.path.join(tmp_path, name + '.npy'), getattr(store, name))
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump(storeMeta(mat_file), f)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        replaceDir(tmp_path, path, lambda path: isStoreValid(path, mat_file))
+        return cls.open(path)
+
+    ## Read-only mapping of a store written by build(); all processes share the same page cache pages
+    @classmethod
+    def open(cls, path):
+        # plain ndarray views of the mappings, slicing np.memmap objects is noticeably slower
+        arrays = {name: np.asarray(np.load(os.path.join(path, name + '.npy'), mmap_mode='r')) for name in STORE_ARRAYS}
+        return cls(arrays, path)
+
+    ## Opens the store of mat_file at path, (re)building it if it is missing or out of date
+    @classmethod
+    def load(cls, mat_file, path=None):
+        path = path or storeDir(mat_file)
+        return cls.open(path) if isStoreValid(path, mat_file) else cls.build(mat_file, path)
+
+    def __getstate__(self):
+        if self.path is not None:
+            return {'path': self.path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'path' in state and len(state) == 1:
+            state = TrackStore.open(state['path']).__dict__
+        self.__dict__.update(state)
+
+    ## (frames, 7) track matrix of vehId in dataset dsId, rows are [frame, x, y, v, a, lane, class]
+    def track(self, vehId, dsId):
+        start = self.offset[dsId - 1, vehId - 1]
+        return self.data[start:start + self.length[dsId - 1, vehId - 1]]
+
+    ## Row of frame t in the track of vehId, -1 if the vehicle isn't observed at t
+    def getRow(self, vehId, t, dsId):
+        n = self.length[dsId - 1, vehId - 1]
+        if n == 0:
+            return -1
+        if not self.contiguous[dsId - 1, vehId - 1]:
+            # the frames of a track ascend, gaps included
+            frames = self.track(vehId, dsId)[:, 0]
+            row = np.searchsorted(frames, t)
+            return int(row) if row < n and frames[row] == t else -1
+        row = t - self.frame0[dsId - 1, vehId - 1]
+        if row < 0 or row >= n or row != int(row):
+            return -1
+        return int(row)